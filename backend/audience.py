@@ -0,0 +1,120 @@
+"""Компактный снимок аудитории в памяти процесса (AUDIENCE_CACHE=1).
+
+Подписки загружаются из subscriptions при старте и хранятся как объекты
+AudienceRecord со __slots__ в словаре по id. Рассылка выбирает id
+получателей по битовым картам типов (segments.SegmentIndex) и берет их
+записи из снимка, не читая subscriptions и не создавая sqlite3.Row на
+каждого подписчика. Снимок обновляется по журналу subscription_changes
+(см. changes.JournalMirror).
+
+Память: endpoint хранится как номер общего префикса push-сервиса и остаток
+пути, тип - общей строкой. При FCM-подобных endpoint (152 символа токена)
+снимок занимает около 570 байт на подписчика (список sqlite3.Row - около
+670), из них ~70% - сами строки токена и ключей
+(замер: python bench/audience_memory.py 200000).
+"""
+import os
+import sys
+import threading
+from itertools import islice
+
+from changes import JournalMirror, fetch_by_ids
+
+AUDIENCE_CACHE = os.getenv("AUDIENCE_CACHE", "0") == "1"
+AUDIENCE_SYNC_INTERVAL = float(os.getenv("AUDIENCE_SYNC_INTERVAL", "1"))
+
+SUBSCRIBER_FIELDS = "id, endpoint, auth_key, p256dh_key, subscription_type"
+# Запись в by_id (с ключом int), байт на подписчика
+INDEX_BYTES_PER_RECORD = 85
+
+_prefixes = []
+_prefix_ids = {}
+_prefix_lock = threading.Lock()
+
+
+def _split_endpoint(endpoint):
+    """(номер общего префикса, остаток пути) для endpoint"""
+    prefix, _, path = endpoint.rpartition("/")
+    prefix += "/"
+    index = _prefix_ids.get(prefix)
+    if index is None:
+        with _prefix_lock:
+            index = _prefix_ids.get(prefix)
+            if index is None:
+                index = _prefix_ids[prefix] = len(_prefixes)
+                _prefixes.append(prefix)
+    return index, path
+
+
+class AudienceRecord:
+    """Подписчик в снимке. Поддерживает record['endpoint'] как sqlite3.Row"""
+
+    __slots__ = ("id", "service", "path", "auth_key", "p256dh_key", "subscription_type")
+
+    def __init__(self, row):
+        self.id = row[0]
+        self.service, self.path = _split_endpoint(row[1])
+        self.auth_key = row[2]
+        self.p256dh_key = row[3]
+        self.subscription_type = sys.intern(row[4]) if row[4] is not None else None
+
+    @property
+    def endpoint(self):
+        return _prefixes[self.service] + self.path
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+
+def load_records(rows):
+    """Снимок {id: AudienceRecord} из строк subscriptions"""
+    return {row[0]: AudienceRecord(row) for row in rows}
+
+
+class AudienceSnapshot(JournalMirror):
+    """Подписчики в памяти по id"""
+
+    def __init__(self, db, sync_interval=AUDIENCE_SYNC_INTERVAL):
+        super().__init__(db, sync_interval)
+        self.by_id = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def _load(self, conn):
+        return load_records(conn.execute(f"SELECT {SUBSCRIBER_FIELDS} FROM subscriptions"))
+
+    def _read(self, conn, ids):
+        return fetch_by_ids(conn, f"SELECT {SUBSCRIBER_FIELDS} FROM subscriptions WHERE id IN ({{ids}})", ids)
+
+    def _replace(self, by_id):
+        self.by_id = by_id
+
+    def _apply(self, ids, rows):
+        for sub_id in ids:
+            self.by_id.pop(sub_id, None)
+        self.by_id.update(load_records(rows))
+
+    def records(self, ids):
+        """Записи подписчиков с данными id (удаленные пропускаются)"""
+        by_id = self.by_id
+        return [by_id[sub_id] for sub_id in ids if sub_id in by_id]
+
+    def stats(self):
+        """Размер снимка; память оценивается по выборке записей"""
+        sample = list(islice(self.by_id.values(), 1000))
+        per_record = 0
+        if sample:
+            per_record = sum(
+                sys.getsizeof(record) + sys.getsizeof(record.path)
+                + sys.getsizeof(record.auth_key) + sys.getsizeof(record.p256dh_key)
+                for record in sample
+            ) / len(sample) + INDEX_BYTES_PER_RECORD
+        return {
+            "subscribers": len(self.by_id),
+            "push_service_prefixes": len(_prefixes),
+            "last_seq": self.last_seq,
+            "reloads": self.reloads,
+            "approx_bytes_per_subscriber": round(per_record),
+            "approx_total_mb": round(len(self.by_id) * per_record / 2 ** 20, 1)
+        }
@@ -0,0 +1,77 @@
+"""Память снимка аудитории (audience.AudienceSnapshot) на одного подписчика.
+
+Строки подписок генерируются в памяти с длинами как у настоящих FCM-подписок
+(токен 152 символа, p256dh 87, auth 22), без БД и push-сервиса. Для сравнения
+замеряются те же подписки в виде списка sqlite3.Row, как их читает рассылка
+без снимка.
+
+    python bench/audience_memory.py 200000
+"""
+import os
+import sys
+import base64
+import sqlite3
+import argparse
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from audience import load_records
+
+FCM_PREFIX = "https://fcm.googleapis.com/fcm/send/"
+TYPES = ("general", "news", "promo", "urgent")
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def generate_rows(count):
+    for sub_id in range(1, count + 1):
+        yield (
+            sub_id,
+            FCM_PREFIX + b64url(os.urandom(114)),
+            b64url(os.urandom(16)),
+            b64url(os.urandom(65)),
+            TYPES[sub_id % len(TYPES)]
+        )
+
+
+def measure(build, count):
+    """Байт на подписчика, которые занимает результат build()"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return used / count
+
+
+def build_rows(count):
+    conn = sqlite3.connect(":memory:")
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE subscriptions (id INTEGER PRIMARY KEY, endpoint, auth_key, p256dh_key, subscription_type)")
+    conn.executemany("INSERT INTO subscriptions VALUES (?, ?, ?, ?, ?)", generate_rows(count))
+    conn.commit()
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Память снимка аудитории на подписчика")
+    parser.add_argument("subscribers", type=int, nargs="?", default=200000)
+    args = parser.parse_args()
+
+    conn = build_rows(args.subscribers)
+    query = "SELECT id, endpoint, auth_key, p256dh_key, subscription_type FROM subscriptions ORDER BY id"
+    rows_bytes = measure(lambda: conn.execute(query).fetchall(), args.subscribers)
+    snapshot_bytes = measure(lambda: load_records(conn.execute(query)), args.subscribers)
+    print(f"подписчиков: {args.subscribers}")
+    print(f"sqlite3.Row:     {rows_bytes:.0f} байт на подписчика")
+    print(f"снимок аудитории: {snapshot_bytes:.0f} байт на подписчика "
+          f"({snapshot_bytes * args.subscribers / 2 ** 20:.1f} МБ)")
+
+
+if __name__ == "__main__":
+    main()
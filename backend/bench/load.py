@@ -0,0 +1,145 @@
+"""Генераторы нагрузки на /api/subscribe, /api/types/stats и /api/send-notification.
+
+Каждый сценарий возвращает словарь с пропускной способностью, p50/p99
+задержки и числом ошибок. Сервер должен быть уже запущен:
+
+    python bench/load.py subscribe --url http://127.0.0.1:5000 --requests 5000 --concurrency 100
+    python bench/load.py stats --requests 20000
+    python bench/load.py broadcast --target all
+"""
+import math
+import time
+import json
+import asyncio
+import argparse
+
+import aiohttp
+
+from seed import generate_client_keys
+
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу (values уже отсортированы)"""
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(name, latencies, errors, duration):
+    latencies.sort()
+    requests = len(latencies) + errors
+    return {
+        "scenario": name,
+        "requests": requests,
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(requests / duration, 1) if duration > 0 else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2) if latencies else None
+    }
+
+
+async def run_requests(name, make_request, requests, concurrency):
+    """Выполнить requests запросов не более concurrency одновременно"""
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker(session):
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            try:
+                async with make_request(session, i) as response:
+                    await response.read()
+                    ok = response.status < 400
+            except aiohttp.ClientError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+    return summarize(name, latencies, errors, duration)
+
+
+async def bench_subscribe(url, requests, concurrency, push_url="http://127.0.0.1:9100",
+                          types=("general", "news", "promo")):
+    """Новые подписки; ключи общие, endpoint уникальный"""
+    p256dh, auth = generate_client_keys()
+    prefix = f"{push_url}/push/sub-{int(time.time())}-"
+
+    def make_request(session, i):
+        return session.post(f"{url}/api/subscribe", json={
+            "endpoint": f"{prefix}{i}",
+            "keys": {"p256dh": p256dh, "auth": auth},
+            "type": types[i % len(types)]
+        })
+
+    return await run_requests("subscribe", make_request, requests, concurrency)
+
+
+async def bench_stats(url, requests, concurrency):
+    def make_request(session, i):
+        return session.get(f"{url}/api/types/stats")
+
+    return await run_requests("types_stats", make_request, requests, concurrency)
+
+
+async def bench_broadcast(url, target="all", poll_interval=0.2):
+    """Одна рассылка от постановки в очередь до завершения задачи"""
+    async with aiohttp.ClientSession() as session:
+        started = time.perf_counter()
+        async with session.post(f"{url}/api/send-notification", json={
+            "title": "bench", "body": "benchmark", "targetType": target
+        }) as response:
+            response.raise_for_status()
+            queued = await response.json()
+        enqueue_time = time.perf_counter() - started
+        while True:
+            async with session.get(f"{url}/api/jobs/{queued['job_id']}") as response:
+                job = await response.json()
+            if job["status"] in ("done", "failed", "superseded"):
+                break
+            await asyncio.sleep(poll_interval)
+        duration = time.perf_counter() - started
+    handled = job["sent"] + job["failed"]
+    return {
+        "scenario": f"broadcast_{target}",
+        "status": job["status"],
+        "recipients": job["total"],
+        "sent": job["sent"],
+        "failed": job["failed"],
+        "deleted": job["deleted"],
+        "enqueue_ms": round(enqueue_time * 1000, 2),
+        "duration_s": round(duration, 3),
+        "throughput_pps": round(handled / duration, 1) if duration > 0 else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузка на запущенный сервер")
+    parser.add_argument("scenario", choices=["subscribe", "stats", "broadcast"])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--push-url", default="http://127.0.0.1:9100")
+    parser.add_argument("--target", default="all")
+    args = parser.parse_args()
+
+    if args.scenario == "subscribe":
+        result = bench_subscribe(args.url, args.requests, args.concurrency, args.push_url)
+    elif args.scenario == "stats":
+        result = bench_stats(args.url, args.requests, args.concurrency)
+    else:
+        result = bench_broadcast(args.url, args.target)
+    print(json.dumps(asyncio.run(result), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Локальный mock push-сервиса для нагрузочных тестов.
+
+Принимает POST /push/<id> с телом в aes128gcm и VAPID-заголовком, отвечает
+201 после настраиваемой задержки, с заданной вероятностью - 404, 410 или 429
+(с Retry-After). GET /stats - счетчики по статусам ответов.
+
+    python bench/mock_push.py --port 9100 --latency 50 --p410 0.05 --p429 0.01
+"""
+import random
+import asyncio
+import argparse
+from collections import Counter
+
+from aiohttp import web
+
+# Минимальный размер тела aes128gcm: заголовок (16 + 4 + 1 + 65) и тег (16)
+MIN_AES128GCM_BODY = 102
+
+
+def create_app(latency=0.0, jitter=0.0, p404=0.0, p410=0.0, p429=0.0, retry_after=1, seed=None):
+    rng = random.Random(seed)
+    stats = Counter()
+
+    async def push(request):
+        body = await request.read()
+        stats["received"] += 1
+        if latency or jitter:
+            await asyncio.sleep(max(0.0, latency + rng.uniform(-jitter, jitter)))
+
+        if request.headers.get("Content-Encoding") != "aes128gcm" or len(body) < MIN_AES128GCM_BODY:
+            status = 400
+        elif not request.headers.get("Authorization", "").startswith("vapid "):
+            status = 401
+        else:
+            roll = rng.random()
+            if roll < p404:
+                status = 404
+            elif roll < p404 + p410:
+                status = 410
+            elif roll < p404 + p410 + p429:
+                status = 429
+            else:
+                status = 201
+        stats[status] += 1
+        headers = {"Retry-After": str(retry_after)} if status == 429 else None
+        return web.Response(status=status, headers=headers)
+
+    async def get_stats(request):
+        return web.json_response({str(key): value for key, value in stats.items()})
+
+    async def reset_stats(request):
+        stats.clear()
+        return web.json_response({"status": "ok"})
+
+    app = web.Application(client_max_size=8192)
+    app.router.add_post("/push/{subscription_id}", push)
+    app.router.add_get("/stats", get_stats)
+    app.router.add_post("/stats/reset", reset_stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock push-сервиса")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=10, help="разброс задержки, мс")
+    parser.add_argument("--p404", type=float, default=0.0, help="доля ответов 404")
+    parser.add_argument("--p410", type=float, default=0.0, help="доля ответов 410")
+    parser.add_argument("--p429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After для 429, секунды")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    app = create_app(
+        latency=args.latency / 1000, jitter=args.jitter / 1000,
+        p404=args.p404, p410=args.p410, p429=args.p429,
+        retry_after=args.retry_after, seed=args.seed
+    )
+    web.run_app(app, host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
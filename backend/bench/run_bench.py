@@ -0,0 +1,211 @@
+"""Полный прогон: mock push-сервиса, заполнение БД, сервер и все сценарии нагрузки.
+
+Все запускается локально во временном каталоге, реальные push-сервисы не
+используются. Результаты (пропускная способность, p50/p99, пиковый RSS
+сервера) печатаются таблицей и сохраняются в JSON; с --baseline выводится
+изменение относительно прошлого прогона.
+
+    python bench/run_bench.py --subscribers 20000 --output bench.json
+    python bench/run_bench.py --subscribers 20000 --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import aiohttp
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import load
+from seed import seed
+
+BENCH_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = BENCH_DIR.parent
+
+# Метрики, где больше - лучше; для остальных лучше меньше
+HIGHER_IS_BETTER = {"throughput_rps", "throughput_pps"}
+COMPARED_FIELDS = ("throughput_rps", "throughput_pps", "p50_ms", "p99_ms", "duration_s",
+                   "peak_rss_mb", "workers_peak_rss_mb")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_vapid_private_key():
+    private_value = ec.generate_private_key(ec.SECP256R1()).private_numbers().private_value
+    return base64.urlsafe_b64encode(private_value.to_bytes(32, "big")).decode().rstrip("=")
+
+
+def read_proc_status(pid, field):
+    """Значение поля /proc/<pid>/status в МБ (только Linux)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """Дочерние процессы, запущенные любым потоком процесса"""
+    children = []
+    for task in Path(f"/proc/{pid}/task").glob("*"):
+        try:
+            children += [int(child) for child in (task / "children").read_text().split()]
+        except OSError:
+            pass
+    return children
+
+
+def peak_rss(pid):
+    """Пиковый RSS процесса (VmHWM) и сумма пиков его дочерних процессов (пул шифрования)"""
+    server = read_proc_status(pid, "VmHWM")
+    children = [read_proc_status(child, "VmHWM") for child in child_pids(pid)]
+    children = [value for value in children if value is not None]
+    return {
+        "peak_rss_mb": round(server, 1) if server is not None else None,
+        "workers_peak_rss_mb": round(sum(children), 1) if children else None
+    }
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не отвечает")
+
+
+async def fetch_json(url, method="GET"):
+    async with aiohttp.ClientSession() as session:
+        async with session.request(method, url) as response:
+            return await response.json()
+
+
+async def run_scenarios(args, server_url, push_url, server_pid):
+    results = []
+    stats_before = await fetch_json(f"{push_url}/stats")
+    results.append(await load.bench_broadcast(server_url, "all"))
+    results[-1]["push_responses"] = {
+        status: count - int(stats_before.get(status, 0))
+        for status, count in (await fetch_json(f"{push_url}/stats")).items()
+    }
+    results.append(await load.bench_subscribe(server_url, args.requests, args.concurrency, push_url))
+    results.append(await load.bench_stats(server_url, args.requests, args.concurrency))
+    return {"scenarios": results, **peak_rss(server_pid)}
+
+
+def print_report(report, baseline=None):
+    baseline_by_name = {}
+    if baseline:
+        baseline_by_name = {item["scenario"]: item for item in baseline["scenarios"]}
+        baseline_by_name["server"] = baseline
+    rows = [(item["scenario"], item) for item in report["scenarios"]] + [("server", report)]
+    for name, item in rows:
+        parts = []
+        for field in COMPARED_FIELDS:
+            value = item.get(field)
+            if value is None:
+                continue
+            text = f"{field}={value}"
+            previous = baseline_by_name.get(name, {}).get(field)
+            if previous:
+                change = (value - previous) / previous * 100
+                better = change > 0 if field in HIGHER_IS_BETTER else change < 0
+                text += f" ({change:+.1f}%{'' if abs(change) < 1 else ' лучше' if better else ' хуже'})"
+            parts.append(text)
+        for field in ("errors", "failed"):
+            if item.get(field):
+                parts.append(f"{field}={item[field]}")
+        print(f"{name:<16} " + "  ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизводимый прогон производительности")
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=5000, help="запросов в сценариях subscribe и stats")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=50, help="задержка mock push-сервиса, мс")
+    parser.add_argument("--jitter", type=float, default=10)
+    parser.add_argument("--p404", type=float, default=0.0)
+    parser.add_argument("--p410", type=float, default=0.02)
+    parser.add_argument("--p429", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="push-bench-"))
+    push_port, server_port = free_port(), free_port()
+    push_url = f"http://127.0.0.1:{push_port}"
+    server_url = f"http://127.0.0.1:{server_port}"
+
+    env = dict(os.environ)
+    env.setdefault("VAPID_PRIVATE_KEY", generate_vapid_private_key())
+    env.setdefault("LOG_LEVEL", "WARNING")
+    env["PYTHONPATH"] = os.pathsep.join([str(BACKEND_DIR), env.get("PYTHONPATH", "")])
+
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, str(BENCH_DIR / "mock_push.py"), "--port", str(push_port),
+            "--latency", str(args.latency), "--jitter", str(args.jitter),
+            "--p404", str(args.p404), "--p410", str(args.p410), "--p429", str(args.p429),
+            "--seed", str(args.seed)
+        ]))
+
+        started = time.perf_counter()
+        conn = sqlite3.connect(workdir / "subscriptions.db")
+        conn.row_factory = sqlite3.Row
+        seed(conn, args.subscribers, push_url)
+        conn.close()
+        print(f"БД заполнена: {args.subscribers} подписок за {time.perf_counter() - started:.1f} с ({workdir})")
+
+        server = subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "server:app",
+            "--app-dir", str(BACKEND_DIR), "--host", "127.0.0.1", "--port", str(server_port),
+            "--log-level", "warning"
+        ], cwd=workdir, env=env)
+        processes.append(server)
+
+        asyncio.run(wait_ready(f"{push_url}/stats"))
+        asyncio.run(wait_ready(f"{server_url}/api/vapid-public-key"))
+        report = asyncio.run(run_scenarios(args, server_url, push_url, server.pid))
+        report["config"] = vars(args)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Заполнение subscriptions.db синтетическими подписками.
+
+У каждой подписки настоящий p256dh (точка на P-256) и auth, поэтому сервер
+шифрует payload так же, как для браузера. Endpoint указывает на mock_push.py.
+Генерация ключа - самая дорогая часть, поэтому ключи берутся по кругу из
+набора --unique-keys пар (на стоимость шифрования это не влияет).
+
+    python bench/seed.py 100000 --db subscriptions.db --push-url http://127.0.0.1:9100
+"""
+import os
+import sys
+import base64
+import sqlite3
+import argparse
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+SEED_BATCH = 10000
+
+
+def b64url(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def generate_client_keys():
+    """Ключи подписки браузера: (p256dh, auth) в base64url"""
+    public_key = ec.generate_private_key(ec.SECP256R1()).public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    return b64url(public_key), b64url(os.urandom(16))
+
+
+def _insert(conn, rows):
+    with conn:
+        return conn.executemany(
+            "INSERT OR IGNORE INTO subscriptions (endpoint, auth_key, p256dh_key, user_agent, subscription_type) "
+            "VALUES (?, ?, ?, ?, ?)", rows
+        ).rowcount
+
+
+def seed(conn, count, push_url, unique_keys=1000, types=None, start=0):
+    """Добавить count подписок, типы по кругу. Возвращает число добавленных"""
+    from migrations import migrate
+
+    migrate(conn)
+    if types is None:
+        types = [row[0] for row in conn.execute("SELECT type_key FROM subscription_types ORDER BY id")]
+    keys = [generate_client_keys() for _ in range(max(1, min(unique_keys, count)))]
+
+    def rows():
+        for i in range(start, start + count):
+            p256dh, auth = keys[i % len(keys)]
+            yield (f"{push_url}/push/{i}", auth, p256dh, "bench", types[i % len(types)])
+
+    inserted = 0
+    batch = []
+    for row in rows():
+        batch.append(row)
+        if len(batch) >= SEED_BATCH:
+            inserted += _insert(conn, batch)
+            batch = []
+    if batch:
+        inserted += _insert(conn, batch)
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические подписки для нагрузочных тестов")
+    parser.add_argument("count", type=int)
+    parser.add_argument("--db", default="subscriptions.db")
+    parser.add_argument("--push-url", default="http://127.0.0.1:9100")
+    parser.add_argument("--unique-keys", type=int, default=1000)
+    parser.add_argument("--start", type=int, default=0, help="номер первой подписки (для дозаполнения)")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    conn.row_factory = sqlite3.Row
+    inserted = seed(conn, args.count, args.push_url, args.unique_keys, start=args.start)
+    conn.close()
+    print(f"Добавлено подписок: {inserted}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Структуры в памяти процесса, повторяющие subscriptions по журналу изменений.
+
+Журнал subscription_changes ведут триггеры на subscriptions (см. migrations.py):
+подписка, смена ключей или типов, удаление при отправке (404/410), очистка
+и clear-all попадают в журнал в той же транзакции. Каждый процесс сам
+читает журнал (раз в sync_interval и по требованию через sync()), поэтому
+копии в воркерах не расходятся с БД. Если журнал уже очищен дальше, чем
+прочитал процесс, или БД пересоздана, копия загружается заново.
+"""
+import os
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# При большем числе изменённых подписок копия загружается заново целиком
+CHANGES_RELOAD_THRESHOLD = int(os.getenv("CHANGES_RELOAD_THRESHOLD", "100000"))
+FETCH_CHUNK = 500
+
+
+def max_seq(conn):
+    """Номер последней записи журнала (0, если записей не было)"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'subscription_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def fetch_by_ids(conn, query, ids):
+    """Строки query для списка id; в query одно место {ids} для IN (...)"""
+    rows = []
+    for start in range(0, len(ids), FETCH_CHUNK):
+        chunk = ids[start:start + FETCH_CHUNK]
+        rows += conn.execute(query.format(ids=",".join("?" * len(chunk))), chunk).fetchall()
+    return rows
+
+
+class JournalMirror:
+    """Базовый класс копии subscriptions в памяти.
+
+    Подкласс реализует _load(conn) (полная загрузка), _read(conn, ids)
+    (текущие строки изменённых подписок, удаленных среди них нет),
+    _replace(state) и _apply(ids, rows). _load и _read выполняются в потоке
+    пула БД, _replace и _apply - в потоке event loop, поэтому читатели могут
+    обращаться к копии между await без блокировок.
+    """
+
+    def __init__(self, db, sync_interval):
+        self.db = db
+        self.sync_interval = sync_interval
+        self.last_seq = 0
+        self.reloads = 0
+        self._sync_lock = asyncio.Lock()
+        self._task = None
+
+    # ---------- Работа с БД (выполняется в потоке пула БД) ----------
+
+    def _load_all(self, conn):
+        conn.execute("BEGIN")
+        try:
+            return max_seq(conn), self._load(conn)
+        finally:
+            conn.rollback()
+
+    def _fetch_changes(self, conn, last_seq):
+        """(seq, изменённые id, их текущие строки) или None, если нужна полная загрузка"""
+        conn.execute("BEGIN")
+        try:
+            seq = max_seq(conn)
+            if seq == last_seq:
+                return seq, [], []
+            first = conn.execute("SELECT MIN(seq) FROM subscription_changes").fetchone()[0]
+            # БД пересоздана или журнал очищен дальше прочитанного
+            if seq < last_seq or first is None or first > last_seq + 1:
+                return None
+            ids = [row[0] for row in conn.execute(
+                "SELECT DISTINCT subscription_id FROM subscription_changes WHERE seq > ? AND seq <= ?",
+                (last_seq, seq)
+            )]
+            if len(ids) > CHANGES_RELOAD_THRESHOLD:
+                return None
+            return seq, ids, self._read(conn, ids)
+        finally:
+            conn.rollback()
+
+    # ---------- Обновление ----------
+
+    async def reload(self):
+        """Загрузить копию целиком"""
+        async with self._sync_lock:
+            self.last_seq, state = await self.db.run(self._load_all)
+            self._replace(state)
+            self.reloads += 1
+        logger.info("Копия подписок загружена", extra={"fields": {
+            "mirror": type(self).__name__, "subscribers": len(self)
+        }})
+
+    async def sync(self):
+        """Применить изменения из журнала. Возвращает число изменённых подписок"""
+        # Без изменений - один запрос без блокировки, параллельно с другими
+        if await self.db.run(max_seq) == self.last_seq:
+            return 0
+        async with self._sync_lock:
+            changes = await self.db.run(self._fetch_changes, self.last_seq)
+            if changes is not None:
+                seq, ids, rows = changes
+                if ids:
+                    self._apply(ids, rows)
+                self.last_seq = seq
+                return len(ids)
+        await self.reload()
+        return len(self)
+
+    async def start(self):
+        await self.reload()
+        if self.sync_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Ошибка обновления копии подписок", extra={"fields": {
+                    "mirror": type(self).__name__
+                }})
@@ -0,0 +1,199 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+import sqlite3
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import DB_LATENCY, current_endpoint
+
+# Настройки пула соединений SQLite
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT = int(os.getenv("DB_BUSY_TIMEOUT", "5000"))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+
+# Окно группового commit для частых одиночных записей (секунды)
+GROUP_COMMIT_WINDOW = float(os.getenv("GROUP_COMMIT_WINDOW", "0.005"))
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "500"))
+
+
+class Database:
+    """Пул долгоживущих соединений SQLite в режиме WAL.
+
+    WAL требует, чтобы все процессы работали с файлом БД на одном хосте
+    (индекс WAL - общая память), поэтому воркеры uvicorn масштабируются
+    только в пределах одного хоста.
+
+    Запросы выполняются на отдельном пуле потоков, поэтому не блокируют
+    event loop. Скомпилированные запросы кэшируются в каждом соединении
+    (cached_statements), так что повторяющиеся запросы не разбираются заново.
+
+    Одиночные запросы выполняются через fetchone/fetchall/execute, несколько
+    запросов в одной транзакции - через run(fn, ...), где fn(conn, ...)
+    работает с соединением и сама фиксирует изменения (with conn: ...).
+    """
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="sqlite")
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Взять соединение из пула (синхронно, для кода вне event loop)"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            conn = self._connect() if create else self._pool.get()
+        try:
+            yield conn
+        finally:
+            # Незавершенная транзакция не должна попасть к следующему запросу
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    def run_sync(self, fn, *args):
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    def _run_timed(self, endpoint, fn, *args):
+        with self.connection() as conn:
+            started = time.perf_counter()
+            try:
+                return fn(conn, *args)
+            finally:
+                DB_LATENCY.observe(time.perf_counter() - started, endpoint)
+
+    async def run(self, fn, *args):
+        """Выполнить fn(conn, *args) в потоке пула БД"""
+        loop = asyncio.get_running_loop()
+        # Поток пула не видит контекст запроса, поэтому эндпоинт передаем явно
+        return await loop.run_in_executor(self._executor, self._run_timed, current_endpoint.get(), fn, *args)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql, params=()):
+        """Выполнить изменяющий запрос в отдельной транзакции. Возвращает rowcount"""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute)
+
+    async def executemany(self, sql, seq_of_params):
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, seq_of_params).rowcount
+        return await self.run(_executemany)
+
+    def close(self):
+        """Закрыть все свободные соединения пула"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+class GroupCommitBuffer:
+    """Буфер записи с групповым commit.
+
+    Параметры одного и того же изменяющего запроса, пришедшие в течение
+    короткого окна, записываются одним executemany в одной транзакции.
+    submit() возвращает управление после commit. Если общая транзакция
+    не удалась из-за данных (IntegrityError, DataError), строки повторяются
+    по одной, чтобы ошибка одной записи не отменяла остальные.
+    """
+
+    def __init__(self, db, sql, window=GROUP_COMMIT_WINDOW, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.db = db
+        self.sql = sql
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._flush_task = None
+
+    async def submit(self, params):
+        """Добавить строку в ближайшую групповую транзакцию и дождаться commit"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((params, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        # Новые строки, пришедшие во время записи, попадут в следующее окно
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+        for start in range(0, len(pending), self.max_batch):
+            chunk = pending[start:start + self.max_batch]
+            try:
+                errors = await self.db.run(self._write, [params for params, _ in chunk])
+            except Exception as e:
+                errors = [e] * len(chunk)
+            for (_, future), error in zip(chunk, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    @property
+    def queued(self):
+        """Строки, ожидающие ближайшего commit"""
+        return len(self._pending)
+
+    def _write(self, conn, rows):
+        # По одной повторяются только строки с ошибкой в данных; блокировка
+        # (OperationalError: database is locked) отменяет всю пачку сразу,
+        # иначе каждая строка ждала бы busy_timeout заново
+        try:
+            with conn:
+                conn.executemany(self.sql, rows)
+            return [None] * len(rows)
+        except (sqlite3.IntegrityError, sqlite3.DataError):
+            pass
+        errors = []
+        for index, row in enumerate(rows):
+            try:
+                with conn:
+                    conn.execute(self.sql, row)
+                errors.append(None)
+            except (sqlite3.IntegrityError, sqlite3.DataError) as e:
+                errors.append(e)
+            except sqlite3.Error as e:
+                # Уже записанные строки остаются успешными, остальные - с этой ошибкой
+                return errors + [e] * (len(rows) - index)
+        return errors
@@ -0,0 +1,208 @@
+"""Журнал доставки: результат рассылки по каждому подписчику.
+
+Рассылка не пишет журнал сама: итоги пачки (BatchResult.deliveries)
+складываются в буфер процесса, а фоновая задача раз в
+DELIVERY_FLUSH_INTERVAL (или сразу при DELIVERY_FLUSH_ROWS строк)
+записывает их в deliveries крупными транзакциями. Строки разворачиваются
+из пачек в потоке пула БД, поэтому event loop на журнал почти не тратится.
+Если БД не успевает и буфер дорос до DELIVERY_BUFFER_MAX, новые пачки
+отбрасываются (счетчик delivery_log_dropped), а не тормозят рассылку.
+
+В той же транзакции обновляется delivery_rollups - число доставок,
+суммарная и максимальная задержка по рассылке, результату и HTTP-статусу.
+Строки deliveries старше DELIVERY_RETENTION_DAYS удаляет Sweeper
+(trim_deliveries); сводка по рассылке остается.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from metrics import current_endpoint, DELIVERY_LOG_ROWS, DELIVERY_LOG_DROPPED
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_LOG = os.getenv("DELIVERY_LOG", "1") == "1"
+DELIVERY_FLUSH_INTERVAL = float(os.getenv("DELIVERY_FLUSH_INTERVAL", "1"))
+DELIVERY_FLUSH_ROWS = int(os.getenv("DELIVERY_FLUSH_ROWS", "10000"))
+DELIVERY_BUFFER_MAX = int(os.getenv("DELIVERY_BUFFER_MAX", "500000"))
+DELIVERY_RETENTION_DAYS = int(os.getenv("DELIVERY_RETENTION_DAYS", "7"))
+DELIVERY_TRIM_BATCH = int(os.getenv("DELIVERY_TRIM_BATCH", "10000"))
+
+DELIVERY_FIELDS = "id, job_id, subscription_id, status, http_status, latency_ms, requests, delivered_at"
+
+
+# ---------- Работа с БД (выполняется в потоке пула БД) ----------
+
+def write_deliveries(conn, entries):
+    """Записать пачки [(job_id, delivered_at, deliveries)] и обновить сводку"""
+    rows = []
+    rollups = {}
+    for job_id, delivered_at, deliveries in entries:
+        for sub_id, status, http_status, latency, requests in deliveries:
+            latency_ms = round(latency * 1000) if latency is not None else None
+            rows.append((job_id, sub_id, status, http_status, latency_ms, requests, delivered_at))
+            key = (job_id, status, http_status or 0)
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollup = rollups[key] = [0, 0, 0]
+            rollup[0] += 1
+            if latency_ms is not None:
+                rollup[1] += latency_ms
+                rollup[2] = max(rollup[2], latency_ms)
+    with conn:
+        conn.executemany(
+            "INSERT INTO deliveries (job_id, subscription_id, status, http_status, latency_ms, requests, delivered_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
+        )
+        conn.executemany("""
+            INSERT INTO delivery_rollups (job_id, status, http_status, deliveries, latency_ms_sum, latency_ms_max)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (job_id, status, http_status) DO UPDATE SET
+                deliveries = deliveries + excluded.deliveries,
+                latency_ms_sum = latency_ms_sum + excluded.latency_ms_sum,
+                latency_ms_max = MAX(latency_ms_max, excluded.latency_ms_max)
+        """, [(*key, *values) for key, values in rollups.items()])
+    return len(rows)
+
+
+def trim_deliveries(conn, retention_days=DELIVERY_RETENTION_DAYS, batch_size=DELIVERY_TRIM_BATCH):
+    """Удалить строки журнала старше retention_days порциями по batch_size.
+
+    Строки пишутся по времени, поэтому старые - в начале таблицы: каждая
+    порция проверяет только batch_size первых id, без индекса по времени.
+    Возвращает число удаленных строк.
+    """
+    cutoff = int(time.time()) - retention_days * 86400
+    deleted = 0
+    while True:
+        with conn:
+            c = conn.execute("""
+                DELETE FROM deliveries WHERE id IN (
+                    SELECT id FROM (SELECT id, delivered_at FROM deliveries ORDER BY id LIMIT ?)
+                    WHERE delivered_at < ?
+                )
+            """, (batch_size, cutoff))
+        deleted += c.rowcount
+        if c.rowcount < batch_size:
+            return deleted
+
+
+def read_job_summary(conn, job_id):
+    """Итоги рассылки по результатам и HTTP-статусам (из delivery_rollups)"""
+    rows = conn.execute("""
+        SELECT status, http_status, deliveries, latency_ms_sum, latency_ms_max
+        FROM delivery_rollups WHERE job_id = ? ORDER BY deliveries DESC
+    """, (job_id,)).fetchall()
+    by_status = {}
+    for row in rows:
+        by_status[row["status"]] = by_status.get(row["status"], 0) + row["deliveries"]
+    return {
+        "reach": by_status.get("sent", 0),
+        "by_status": by_status,
+        "by_http_status": [{
+            "status": row["status"],
+            "http_status": row["http_status"] or None,
+            "deliveries": row["deliveries"],
+            "avg_latency_ms": round(row["latency_ms_sum"] / row["deliveries"], 1),
+            "max_latency_ms": row["latency_ms_max"]
+        } for row in rows]
+    }
+
+
+def read_job_deliveries(conn, job_id, after_id=0, limit=100, status=None):
+    """Страница журнала рассылки по возрастанию id (после after_id)"""
+    sql = f"SELECT {DELIVERY_FIELDS} FROM deliveries WHERE job_id = ? AND id > ?"
+    params = [job_id, after_id]
+    if status is not None:
+        sql += " AND status = ?"
+        params.append(status)
+    return [dict(row) for row in conn.execute(sql + " ORDER BY id LIMIT ?", (*params, limit))]
+
+
+def read_subscription_deliveries(conn, subscription_id, before_id=None, limit=100):
+    """История доставки подписчику от новых к старым (до before_id)"""
+    rows = conn.execute(f"""
+        SELECT d.id, d.job_id, d.status, d.http_status, d.latency_ms, d.requests, d.delivered_at,
+               j.target_type, j.topic, json_extract(j.payload, '$.title') AS title
+        FROM deliveries d
+        LEFT JOIN dispatch_jobs j ON j.id = d.job_id
+        WHERE d.subscription_id = ? AND d.id < ?
+        ORDER BY d.id DESC LIMIT ?
+    """, (subscription_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+    return [dict(row) for row in rows]
+
+
+class DeliveryLog:
+    """Буфер журнала доставки с отложенной записью (write-behind)"""
+
+    def __init__(self, db, flush_interval=DELIVERY_FLUSH_INTERVAL, flush_rows=DELIVERY_FLUSH_ROWS,
+                 buffer_max=DELIVERY_BUFFER_MAX):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.buffer_max = buffer_max
+        self.pending = []
+        self.buffered = 0
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def add(self, job_id, batch):
+        """Добавить итоги пачки рассылки job_id в буфер (без ожидания записи)"""
+        count = len(batch.deliveries)
+        if self.buffered + count > self.buffer_max:
+            DELIVERY_LOG_DROPPED.inc(amount=count)
+            return
+        self.pending.append((job_id, int(time.time()), batch.deliveries))
+        self.buffered += count
+        if self.buffered >= self.flush_rows:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Записать все накопленные строки. Возвращает число записанных"""
+        async with self._flush_lock:
+            pending, self.pending = self.pending, []
+            written = 0
+            while pending:
+                # Транзакция - пачки на flush_rows строк
+                size = 0
+                count = 0
+                while count < len(pending) and size < self.flush_rows:
+                    size += len(pending[count][2])
+                    count += 1
+                try:
+                    await self.db.run(write_deliveries, pending[:count])
+                except Exception:
+                    # Незаписанное возвращается в начало буфера до следующей попытки
+                    self.pending[:0] = pending
+                    logger.exception("Ошибка записи журнала доставки", extra={"fields": {"rows": self.buffered}})
+                    break
+                del pending[:count]
+                self.buffered -= size
+                written += size
+                DELIVERY_LOG_ROWS.inc(amount=size)
+            return written
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и дописать буфер"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        current_endpoint.set("delivery_log")
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -0,0 +1,524 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+from itertools import islice
+
+from pruning import record_batch_results
+from metrics import current_endpoint
+from changes import fetch_by_ids
+from segments import iter_ids, split_ranges
+from push_sender import push_headers
+
+logger = logging.getLogger(__name__)
+
+# Настройки фоновой рассылки
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "2"))
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "500"))
+DISPATCH_POLL_INTERVAL = float(os.getenv("DISPATCH_POLL_INTERVAL", "5"))
+
+# Размер части рассылки (получателей) и срок аренды части воркером (секунды)
+DISPATCH_SHARD_SIZE = int(os.getenv("DISPATCH_SHARD_SIZE", "10000"))
+DISPATCH_LEASE = float(os.getenv("DISPATCH_LEASE", "60"))
+
+# Повторы части после ошибки (например, database is locked): число попыток
+# и задержка перед следующей (удваивается с каждой попыткой, секунды)
+DISPATCH_SHARD_MAX_ATTEMPTS = int(os.getenv("DISPATCH_SHARD_MAX_ATTEMPTS", "5"))
+DISPATCH_RETRY_BASE_DELAY = float(os.getenv("DISPATCH_RETRY_BASE_DELAY", "5"))
+DISPATCH_RETRY_MAX_DELAY = float(os.getenv("DISPATCH_RETRY_MAX_DELAY", "300"))
+
+JOB_FIELDS = ("id, target_type, status, total, sent, failed, deleted, error, created_at, started_at, finished_at, "
+              "send_at, ttl, topic, urgency")
+
+
+class LeaseLost(Exception):
+    """Часть рассылки уже забрал другой воркер"""
+
+
+class Dispatcher:
+    """Фоновая рассылка по частям (диапазонам subscription_id) воркерами всех процессов"""
+
+    def __init__(self, db, push_sender, segments, workers=DISPATCH_WORKERS, batch_size=DISPATCH_BATCH_SIZE,
+                 shard_size=DISPATCH_SHARD_SIZE, lease=DISPATCH_LEASE, audience=None, deliveries=None):
+        self.db = db
+        self.push_sender = push_sender
+        self.segments = segments
+        self.audience = audience
+        self.deliveries = deliveries
+        self.workers = workers
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.lease = lease
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    # ---------- Работа с БД (выполняется в потоке пула БД) ----------
+
+    def _insert_job(self, conn, target_type, payload, options, status="queued", send_at=None):
+        c = conn.execute(
+            "INSERT INTO dispatch_jobs (target_type, payload, status, send_at, ttl, topic, urgency) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (target_type, payload, status, send_at, options.get("ttl"), options.get("topic"), options.get("urgency"))
+        )
+        return c.lastrowid
+
+    def _supersede(self, conn, job_id, target_type, topic):
+        """Снять с отправки незавершенные задачи той же аудитории и темы,
+        созданные раньше job_id. Возвращает их число"""
+        if topic is None:
+            return 0
+        # Отложенные задачи частей не имеют и снимаются целиком
+        c = conn.cursor()
+        old_ids = [row[0] for row in c.execute(
+            "SELECT id FROM dispatch_jobs WHERE topic = ? AND target_type = ? AND id < ? "
+            "AND status IN ('scheduled', 'queued', 'running')",
+            (topic, target_type, job_id)
+        )]
+        for old_id in old_ids:
+            # Части, которые уже отправляются, завершатся сами; не начатые снимаются
+            c.execute(
+                "UPDATE dispatch_shards SET status = 'superseded' WHERE job_id = ? AND status = 'queued'",
+                (old_id,)
+            )
+            c.execute("""
+                UPDATE dispatch_jobs SET status = 'superseded', error = ?, finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND NOT EXISTS (SELECT 1 FROM dispatch_shards WHERE job_id = ? AND status = 'running')
+            """, (f"заменена рассылкой {job_id}", old_id, old_id))
+        return len(old_ids)
+
+    def _add_shards(self, conn, job_id, ranges):
+        """Части задачи по диапазонам split_ranges; задача без получателей сразу завершается"""
+        c = conn.cursor()
+        total = sum(count for _, _, count in ranges)
+        if total:
+            c.executemany(
+                "INSERT INTO dispatch_shards (job_id, shard, first_id, last_id, total) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, shard, first_id, last_id, count) for shard, (first_id, last_id, count) in enumerate(ranges)]
+            )
+            c.execute("UPDATE dispatch_jobs SET total = ? WHERE id = ?", (total, job_id))
+        else:
+            c.execute(
+                "UPDATE dispatch_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (job_id,)
+            )
+        return total
+
+    def _create_job(self, conn, target_type, payload, ranges, options):
+        job_id = self._insert_job(conn, target_type, payload, options)
+        superseded = self._supersede(conn, job_id, target_type, options.get("topic"))
+        total = self._add_shards(conn, job_id, ranges)
+        conn.commit()
+        return job_id, total, superseded
+
+    def _schedule_job(self, conn, target_type, payload, send_at, options):
+        job_id = self._insert_job(conn, target_type, payload, options, "scheduled", send_at)
+        superseded = self._supersede(conn, job_id, target_type, options.get("topic"))
+        conn.commit()
+        return job_id, superseded
+
+    def _scheduled_target(self, conn, job_id):
+        row = conn.execute(
+            "SELECT target_type FROM dispatch_jobs WHERE id = ? AND status = 'scheduled'", (job_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _activate_job(self, conn, job_id, ranges):
+        """Поставить отложенную задачу в очередь. None - задачу уже запустил
+        другой процесс или она заменена"""
+        c = conn.execute("UPDATE dispatch_jobs SET status = 'queued' WHERE id = ? AND status = 'scheduled'", (job_id,))
+        if c.rowcount == 0:
+            conn.rollback()
+            return None
+        total = self._add_shards(conn, job_id, ranges)
+        conn.commit()
+        return total
+
+    def _claim_shard(self, conn):
+        # Часть выдается в аренду (lease_until), которую воркер продлевает;
+        # часть упавшего процесса забирается после истечения аренды, а
+        # часть после ошибки - не раньше retry_at
+        now = time.time()
+        shard = conn.execute("""
+            UPDATE dispatch_shards
+            SET status = 'running', worker = ?, lease_until = ?
+            WHERE (job_id, shard) = (
+                SELECT job_id, shard FROM dispatch_shards
+                WHERE (status = 'queued' AND (retry_at IS NULL OR retry_at <= ?))
+                   OR (status = 'running' AND lease_until < ?)
+                ORDER BY job_id, shard LIMIT 1
+            )
+            RETURNING job_id, shard, first_id, last_id, COALESCE(cursor, first_id - 1) AS cursor, attempts, ahead
+        """, (self.worker_id, now + self.lease, now, now)).fetchone()
+        if shard is None:
+            conn.commit()
+            return None
+        shard = dict(shard)
+        shard["ahead"] = [tuple(bounds) for bounds in json.loads(shard["ahead"] or "[]")]
+        job = conn.execute("""
+            UPDATE dispatch_jobs
+            SET status = 'running', started_at = COALESCE(started_at, CURRENT_TIMESTAMP)
+            WHERE id = ?
+            RETURNING target_type, payload, ttl, topic, urgency
+        """, (shard["job_id"],)).fetchone()
+        conn.commit()
+        shard.update(job)
+        return shard
+
+    def _renew_lease(self, conn, shard):
+        """Продлить аренду части. False - часть уже забрал другой воркер"""
+        c = conn.execute(
+            "UPDATE dispatch_shards SET lease_until = ? WHERE job_id = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (time.time() + self.lease, shard["job_id"], shard["shard"], self.worker_id)
+        )
+        conn.commit()
+        return c.rowcount > 0
+
+    def _fetch_batch(self, conn, ids):
+        """Подписки с данными id (удаленные пропускаются)"""
+        return fetch_by_ids(conn, """
+            SELECT id, endpoint, auth_key, p256dh_key, subscription_type
+            FROM subscriptions WHERE id IN ({ids}) ORDER BY id
+        """, ids)
+
+    def _record_batch(self, conn, shard, batch, cursor=None, ahead=None):
+        job_id = shard["job_id"]
+        c = conn.cursor()
+        c.execute(
+            "UPDATE dispatch_shards SET handled = handled + ?, cursor = COALESCE(?, cursor), ahead = ? "
+            "WHERE job_id = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (batch.sent + batch.failed, cursor, json.dumps(ahead) if ahead else None,
+             job_id, shard["shard"], self.worker_id)
+        )
+        if c.rowcount == 0:
+            conn.rollback()
+            raise LeaseLost()
+        record_batch_results(conn, batch)
+        c.execute(
+            "UPDATE dispatch_jobs SET sent = sent + ?, failed = failed + ?, deleted = deleted + ? WHERE id = ?",
+            (batch.sent, batch.failed, len(batch.expired_ids), job_id)
+        )
+        conn.commit()
+
+    def _finish_shard(self, conn, shard, status, error=None):
+        """Завершить часть; с последней частью завершается задача. Возвращает
+        итоговый статус задачи или None, если остались незавершенные части.
+        LeaseLost, если часть уже забрал другой воркер"""
+        job_id = shard["job_id"]
+        c = conn.cursor()
+        c.execute(
+            "UPDATE dispatch_shards SET status = ?, error = ?, lease_until = NULL "
+            "WHERE job_id = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (status, error, job_id, shard["shard"], self.worker_id)
+        )
+        if c.rowcount == 0:
+            conn.rollback()
+            raise LeaseLost()
+        if status == "done":
+            # Получатели части определились при отправке: итог задачи уточняется
+            c.execute("""
+                UPDATE dispatch_jobs SET total = total + (
+                    SELECT handled - total FROM dispatch_shards WHERE job_id = ? AND shard = ?
+                ) WHERE id = ?
+            """, (job_id, shard["shard"], job_id))
+            c.execute(
+                "UPDATE dispatch_shards SET total = handled WHERE job_id = ? AND shard = ?",
+                (job_id, shard["shard"])
+            )
+        c.execute("""
+            SELECT SUM(status IN ('queued', 'running')), MAX(CASE WHEN status = 'failed' THEN error END),
+                   SUM(status = 'superseded')
+            FROM dispatch_shards WHERE job_id = ?
+        """, (job_id,))
+        unfinished, job_error, superseded = c.fetchone()
+        job_status = None
+        if not unfinished:
+            job_status = "failed" if job_error is not None else "superseded" if superseded else "done"
+            c.execute(
+                "UPDATE dispatch_jobs SET status = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (job_status, job_error, job_id)
+            )
+        conn.commit()
+        return job_status
+
+    def _retry_shard(self, conn, shard, error):
+        """Вернуть часть в очередь после ошибки с задержкой. False - попытки
+        исчерпаны. Если часть уже забрал другой воркер, она остается у него"""
+        attempts = shard["attempts"] + 1
+        if attempts >= DISPATCH_SHARD_MAX_ATTEMPTS:
+            return False
+        delay = min(DISPATCH_RETRY_BASE_DELAY * 2 ** (attempts - 1), DISPATCH_RETRY_MAX_DELAY)
+        conn.execute(
+            "UPDATE dispatch_shards SET status = 'queued', worker = NULL, lease_until = NULL, "
+            "attempts = ?, retry_at = ?, error = ? "
+            "WHERE job_id = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (attempts, time.time() + delay, error, shard["job_id"], shard["shard"], self.worker_id)
+        )
+        conn.commit()
+        return True
+
+    def _release_shard(self, conn, shard):
+        """Вернуть часть в очередь (при остановке процесса)"""
+        conn.execute(
+            "UPDATE dispatch_shards SET status = 'queued', worker = NULL, lease_until = NULL "
+            "WHERE job_id = ? AND shard = ? AND worker = ? AND status = 'running'",
+            (shard["job_id"], shard["shard"], self.worker_id)
+        )
+        conn.commit()
+
+    def _get_job(self, conn, job_id):
+        job = conn.execute(f"SELECT {JOB_FIELDS} FROM dispatch_jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        job = dict(job)
+        rows = conn.execute(
+            "SELECT status, COUNT(*) FROM dispatch_shards WHERE job_id = ? GROUP BY status", (job_id,)
+        ).fetchall()
+        job["shards"] = {row[0]: row[1] for row in rows}
+        return job
+
+    def _job_stats(self, conn):
+        rows = conn.execute("""
+            SELECT status, COUNT(*), COALESCE(SUM(total - sent - failed), 0)
+            FROM dispatch_jobs GROUP BY status
+        """).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    # ---------- Публичный интерфейс ----------
+
+    async def enqueue(self, target_type, payload, **options):
+        """Поставить рассылку в очередь. target_type - выражение таргетинга,
+        options - ttl, topic, urgency (см. push_headers).
+        Возвращает (job_id, число получателей, число замененных задач)"""
+        # Подписки, сохраненные до постановки задачи, должны попасть в карты
+        await self.segments.sync()
+        ranges = split_ranges(self.segments.evaluate(target_type), self.shard_size)
+        job_id, total, superseded = await self.db.run(
+            self._create_job, target_type, payload, ranges, options
+        )
+        self._wakeup.set()
+        return job_id, total, superseded
+
+    async def schedule(self, target_type, payload, send_at, **options):
+        """Сохранить отложенную рассылку (send_at - unix-время).
+        Возвращает (job_id, число замененных задач)"""
+        return await self.db.run(self._schedule_job, target_type, payload, send_at, options)
+
+    async def activate(self, job_id):
+        """Поставить наступившую отложенную рассылку в очередь. Возвращает
+        число получателей или None, если задачу уже запустил другой процесс"""
+        target_type = await self.db.run(self._scheduled_target, job_id)
+        if target_type is None:
+            return None
+        await self.segments.sync()
+        ranges = split_ranges(self.segments.evaluate(target_type), self.shard_size)
+        total = await self.db.run(self._activate_job, job_id, ranges)
+        if total is not None:
+            self._wakeup.set()
+        return total
+
+    async def get_job(self, job_id):
+        """Текущее состояние задачи (сводное по всем частям) или None"""
+        job = await self.db.run(self._get_job, job_id)
+        if job:
+            done = job["sent"] + job["failed"]
+            if job["status"] == "scheduled":
+                # Получатели отложенной задачи определятся при отправке
+                job["progress"] = None
+            else:
+                job["progress"] = round(100 * done / job["total"], 1) if job["total"] else 100.0
+        return job
+
+    async def job_stats(self):
+        """{status: (число задач, неотправленные получатели)}"""
+        return await self.db.run(self._job_stats)
+
+    async def start(self):
+        """Запустить воркеры. Прерванные части подхватываются по истечении аренды"""
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        self._wakeup.set()
+
+    async def stop(self):
+        """Остановить воркеры. Незавершенные части возвращаются в очередь"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        current_endpoint.set("dispatcher")
+        while True:
+            self._wakeup.clear()
+            try:
+                shard = await self.db.run(self._claim_shard)
+            except Exception:
+                # Например, database is locked: воркер повторит после паузы
+                logger.exception("Не удалось получить часть рассылки")
+                shard = None
+            if shard is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=DISPATCH_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Пока есть части, будим остальных воркеров
+            self._wakeup.set()
+            try:
+                await self._run_shard(shard)
+            except Exception:
+                # Часть останется в аренде и после её истечения достанется другому воркеру
+                logger.exception("Ошибка обработки части рассылки", extra={"fields": {
+                    "job_id": shard["job_id"], "shard": shard["shard"]
+                }})
+
+    async def _iter_batches(self, shard):
+        """Получатели части пачками по возрастанию id, начиная после cursor.
+
+        id берутся из битовой карты выражения таргетинга, подписки - из
+        снимка аудитории или из subscriptions по первичному ключу; следующая
+        пачка читается заранее, пока отправляется текущая.
+        """
+        syncs = [self.segments.sync()]
+        if self.audience is not None:
+            syncs.append(self.audience.sync())
+        await asyncio.gather(*syncs)
+        recipients = self.segments.evaluate(shard["target_type"])
+        ids = iter_ids(recipients, shard["cursor"], shard["last_id"])
+        if shard["ahead"]:
+            ids = (sub_id for sub_id in ids if not any(first <= sub_id <= last for first, last in shard["ahead"]))
+
+        def next_ids():
+            return list(islice(ids, self.batch_size))
+
+        if self.audience is not None:
+            while page := next_ids():
+                # Записи берутся перед отправкой пачки: удаленные за это время пропускаются
+                batch = self.audience.records(page)
+                if batch:
+                    yield batch
+            return
+        page = next_ids()
+        next_page = asyncio.ensure_future(self.db.run(self._fetch_batch, page)) if page else None
+        try:
+            while next_page is not None:
+                batch = await next_page
+                page = next_ids()
+                next_page = asyncio.ensure_future(self.db.run(self._fetch_batch, page)) if page else None
+                if batch:
+                    yield batch
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def _keep_lease(self, shard, sending):
+        """Продлевать аренду, пока идет отправка. True - аренда потеряна"""
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await self.db.run(self._renew_lease, shard)
+            except Exception:
+                logger.exception("Не удалось продлить аренду части рассылки", extra={"fields": {
+                    "job_id": shard["job_id"], "shard": shard["shard"]
+                }})
+                # Пока аренда не истекла, пробуем снова; после - часть может
+                # забрать другой воркер, поэтому отправка останавливается
+                renewed = time.monotonic() - renewed_at < self.lease
+                if renewed:
+                    continue
+            if not renewed:
+                sending.cancel()
+                return True
+            renewed_at = time.monotonic()
+
+    async def _run_shard(self, shard):
+        job_id = shard["job_id"]
+        fields = {"job_id": job_id, "shard": shard["shard"]}
+        if self.push_sender.vapid_cache is None:
+            # Без ключа VAPID не уйдет ни одно сообщение: часть завершается
+            # ошибкой сразу, без отказа по каждому подписчику
+            logger.error("VAPID_PRIVATE_KEY не задан, часть рассылки не отправлена", extra={"fields": fields})
+            await self.db.run(self._finish_shard, shard, "failed", "VAPID_PRIVATE_KEY не задан")
+            return
+        logger.info("Часть рассылки запущена", extra={"fields": fields})
+        started = time.monotonic()
+
+        # Прерванная часть продолжается после cursor, пропуская пачки из
+        # ahead, поэтому повторно может уйти лишь незафиксированная пачка.
+        # Пачки завершаются не по порядку (повторы), поэтому позиция части -
+        # конец самого длинного полностью завершенного начала: {первый id: последний id}
+        unfinished = {}
+        finished = set()
+        position = shard["cursor"]
+
+        async def batches():
+            async for batch in self._iter_batches(shard):
+                unfinished[batch[0]['id']] = batch[-1]['id']
+                yield batch
+
+        async def record_batch(batch):
+            nonlocal position
+            finished.add(batch.subscriptions[0]['id'])
+            cursor = None
+            while unfinished and next(iter(unfinished)) in finished:
+                first_id = next(iter(unfinished))
+                finished.discard(first_id)
+                cursor = position = unfinished.pop(first_id)
+            # Завершенные пачки после позиции не отправляются повторно при продолжении
+            ahead = sorted(
+                [bounds for bounds in shard["ahead"] if bounds[0] > position]
+                + [(first_id, unfinished[first_id]) for first_id in finished]
+            )
+            if self.deliveries is not None:
+                self.deliveries.add(job_id, batch)
+            await self.db.run(self._record_batch, shard, batch, cursor, ahead)
+
+        sending = asyncio.ensure_future(
+            self.push_sender.broadcast(
+                batches(), shard["payload"], record_batch,
+                push_headers(shard["ttl"], shard["topic"], shard["urgency"])
+            )
+        )
+        lease = asyncio.ensure_future(self._keep_lease(shard, sending))
+        try:
+            totals = await sending
+            job_status = await self.db.run(self._finish_shard, shard, "done")
+
+            # Одна итоговая запись на часть вместо строк по каждому подписчику
+            duration = time.monotonic() - started
+            handled = totals["sent"] + totals["failed"]
+            logger.info("Часть рассылки завершена", extra={"fields": {
+                **fields,
+                **totals,
+                "duration_s": round(duration, 2),
+                "per_second": round(handled / duration, 1) if duration > 0 else handled
+            }})
+            if job_status is not None:
+                logger.info("Рассылка завершена", extra={"fields": {"job_id": job_id, "status": job_status}})
+        except asyncio.CancelledError:
+            if lease.done() and not lease.cancelled() and lease.result():
+                logger.warning("Аренда части потеряна, отправку продолжит другой воркер", extra={"fields": fields})
+                return
+            # Остановка процесса: часть сразу достанется другому воркеру
+            await self.db.run(self._release_shard, shard)
+            raise
+        except LeaseLost:
+            # Аренда истекла раньше, чем это заметило продление
+            logger.warning("Аренда части потеряна, отправку продолжит другой воркер", extra={"fields": fields})
+        except Exception as e:
+            logger.exception("Часть рассылки завершилась ошибкой", extra={"fields": fields})
+            try:
+                if await self.db.run(self._retry_shard, shard, str(e)):
+                    logger.warning("Часть рассылки будет повторена", extra={"fields": {
+                        **fields, "attempt": shard["attempts"] + 1
+                    }})
+                else:
+                    await self.db.run(self._finish_shard, shard, "failed", str(e))
+            except Exception:
+                # Часть останется в аренде и после её истечения достанется другому воркеру
+                logger.exception("Не удалось вернуть часть рассылки в очередь", extra={"fields": fields})
+        finally:
+            lease.cancel()
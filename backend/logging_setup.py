@@ -0,0 +1,115 @@
+"""Структурированное логирование без блокировки event loop.
+
+Записи складываются в ограниченную очередь и пишутся в stdout отдельным
+потоком (QueueListener). Если очередь переполнена, запись отбрасывается,
+а не задерживает рассылку. Дополнительные поля передаются через
+extra={"fields": {...}} и выводятся как key=value или как JSON (LOG_FORMAT=json).
+
+Записи по отдельным подписчикам идут через log_subscriber(): DEBUG-записи
+выборочные (LOG_SAMPLE_RATE), а все вместе ограничены LOG_SUBSCRIBER_RATE
+записями в секунду. Итоги рассылки пишутся одной записью на задачу.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+LOG_SUBSCRIBER_RATE = float(os.getenv("LOG_SUBSCRIBER_RATE", "20"))
+
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """Сообщение плюс поля из extra={"fields": {...}}"""
+
+    def __init__(self, as_json=False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.as_json:
+            entry = {
+                "ts": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "msg": record.getMessage(),
+                **fields
+            }
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SubscriberLogSampler:
+    """Выборка и ограничение частоты записей по отдельным подписчикам"""
+
+    def __init__(self, rate=LOG_SUBSCRIBER_RATE, sample_rate=LOG_SAMPLE_RATE):
+        self.rate = rate
+        self.sample_rate = sample_rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self, level):
+        if level < logging.WARNING and random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+subscriber_sampler = SubscriberLogSampler()
+
+
+def log_subscriber(logger, level, msg, **fields):
+    """Запись о доставке конкретному подписчику (с выборкой и лимитом)"""
+    if logger.isEnabledFor(level) and subscriber_sampler.allow(level):
+        logger.log(level, msg, extra={"fields": fields})
+
+
+def setup_logging():
+    """Настроить корневой логгер: очередь + отдельный поток записи в stdout"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(as_json=(LOG_FORMAT == "json")))
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers = [DroppingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -0,0 +1,242 @@
+"""Метрики в текстовом формате Prometheus (GET /metrics).
+
+Счетчики и гистограммы хранятся в словарях по кортежу значений меток и
+обновляются под коротким локом, поэтому их можно оставлять включенными в
+рабочем режиме. Значения, которые дешевле посчитать при чтении (лимиты
+push-сервисов, глубина очередей), задаются функциями и вычисляются только
+при запросе /metrics.
+
+Запросы к SQLite размечаются эндпоинтом из current_endpoint: эндпоинты
+выставляют его через зависимость FastAPI, фоновые задачи - сами.
+"""
+import bisect
+import threading
+import contextvars
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+current_endpoint = contextvars.ContextVar("current_endpoint", default="other")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        # Счетчик без меток выводится сразу, со значением 0
+        if not self.label_names:
+            self._values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}_total{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Metric):
+    """Значение, которое выставляется напрямую или считается функцией при чтении.
+
+    fn() возвращает число (без меток) или {кортеж значений меток: число}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labels=(), fn=None):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+        if not self.label_names:
+            self._values[()] = 0
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def replace(self, values):
+        """Заменить все значения: {кортеж значений меток: число}"""
+        with self._lock:
+            self._values = dict(values)
+
+    def render(self):
+        lines = self.header()
+        if self.fn is not None:
+            values = self.fn()
+            values = values.items() if isinstance(values, dict) else [((), values)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Счетчики по корзинам (последняя - +Inf) и сумма наблюдений
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, le)} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), fn=None):
+        return self.register(Gauge(name, documentation, labels, fn))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# ---------- Рассылка ----------
+
+PUSH_RESULTS = registry.counter(
+    "push_notifications",
+    "Окончательные результаты доставки (sent, failed, expired)",
+    ("service", "type", "result")
+)
+PUSH_RETRIES = registry.counter(
+    "push_retries",
+    "Повторы после 429/5xx и сетевых ошибок",
+    ("service",)
+)
+PUSH_LATENCY = registry.histogram(
+    "push_request_duration_seconds",
+    "Время HTTP-запроса к push-сервису",
+    ("service",)
+)
+PUSH_IN_FLIGHT = registry.gauge(
+    "push_in_flight",
+    "Запросы к push-сервисам, выполняющиеся сейчас"
+)
+ENCRYPT_LATENCY = registry.histogram(
+    "push_encrypt_chunk_duration_seconds",
+    "Время шифрования одной порции подписчиков (с ожиданием пула процессов)",
+    buckets=FAST_BUCKETS
+)
+ENCRYPTED_MESSAGES = registry.counter(
+    "push_encrypted_messages",
+    "Зашифрованные сообщения"
+)
+
+# ---------- Очереди ----------
+
+DISPATCH_JOBS = registry.gauge(
+    "dispatch_jobs",
+    "Задачи рассылки по статусам",
+    ("status",)
+)
+DISPATCH_PENDING = registry.gauge(
+    "dispatch_pending_recipients",
+    "Получатели, которым уведомление ещё не отправлено, по статусам задач",
+    ("status",)
+)
+
+# ---------- Журнал доставки ----------
+
+DELIVERY_LOG_ROWS = registry.counter(
+    "delivery_log_rows",
+    "Строки журнала доставки, записанные в БД"
+)
+DELIVERY_LOG_DROPPED = registry.counter(
+    "delivery_log_dropped",
+    "Строки журнала доставки, отброшенные из-за переполнения буфера"
+)
+
+# ---------- SQLite ----------
+
+DB_LATENCY = registry.histogram(
+    "sqlite_query_duration_seconds",
+    "Время выполнения запросов к SQLite в потоке пула (без ожидания свободного потока)",
+    ("endpoint",),
+    buckets=FAST_BUCKETS
+)
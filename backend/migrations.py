@@ -0,0 +1,285 @@
+"""Версионные миграции схемы через PRAGMA user_version.
+
+Каждая миграция выполняется один раз, в порядке номеров, и вместе с новым
+user_version фиксируется одной транзакцией. Если БД уже актуальна, migrate()
+читает только user_version, поэтому старт сервера не зависит от размера БД.
+
+Несколько процессов (воркеры uvicorn на одном хосте) могут стартовать
+одновременно: миграции выполняются под блокировкой записи SQLite
+(BEGIN IMMEDIATE), остальные процессы ждут её и затем видят готовую схему.
+
+Новая миграция - функция fn(conn) без commit, добавленная в конец MIGRATIONS.
+"""
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать, пока миграции выполняет другой процесс (секунды)
+MIGRATION_LOCK_TIMEOUT = float(os.getenv("MIGRATION_LOCK_TIMEOUT", "600"))
+
+INITIAL_TYPES = [
+    ('general', 'Общие уведомления', 'Обычные уведомления для всех', '#e2e3e5'),
+    ('news', 'Новости', 'Новости и обновления', '#cce5ff'),
+    ('promo', 'Акции и скидки', 'Специальные предложения', '#d4edda'),
+    ('urgent', 'Срочные уведомления', 'Важные сообщения', '#f8d7da')
+]
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def migration_1_baseline(conn):
+    """Схема прежнего init_db: типы и подписки. Для БД, созданных им,
+    добавляет subscription_type"""
+    c = conn.cursor()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS subscription_types (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            type_key TEXT UNIQUE NOT NULL,
+            type_name TEXT NOT NULL,
+            type_description TEXT,
+            type_color TEXT DEFAULT '#e2e3e5',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if c.execute("SELECT COUNT(*) FROM subscription_types").fetchone()[0] == 0:
+        c.executemany(
+            "INSERT INTO subscription_types (type_key, type_name, type_description, type_color) VALUES (?, ?, ?, ?)",
+            INITIAL_TYPES
+        )
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            endpoint TEXT UNIQUE,
+            auth_key TEXT,
+            p256dh_key TEXT,
+            user_agent TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    if 'subscription_type' not in _columns(conn, "subscriptions"):
+        c.execute("ALTER TABLE subscriptions ADD COLUMN subscription_type TEXT DEFAULT 'general'")
+    # Старые подписки без типа
+    c.execute("UPDATE subscriptions SET subscription_type = 'general' WHERE subscription_type IS NULL")
+
+
+def migration_2_dispatch(conn):
+    """Фоновые рассылки, подписка на несколько типов, журналы изменений и доставки"""
+    c = conn.cursor()
+
+    # Счетчики доставки для очистки неактивных подписок (см. pruning.py)
+    c.execute("ALTER TABLE subscriptions ADD COLUMN failure_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE subscriptions ADD COLUMN last_success_at DATETIME")
+    c.execute("ALTER TABLE subscriptions ADD COLUMN last_failure_at DATETIME")
+    c.execute("CREATE INDEX idx_subscriptions_failures ON subscriptions (failure_count) WHERE failure_count > 0")
+
+    # Типы подписки: JSON-массив в subscriptions.type_keys, триггеры
+    # раскладывают его в subscription_type_members, поэтому подписка
+    # по-прежнему сохраняется одним INSERT ... ON CONFLICT. Без type_keys
+    # подписка входит в свой subscription_type (основной тип)
+    c.execute("ALTER TABLE subscriptions ADD COLUMN type_keys TEXT")
+    c.execute('''
+        CREATE TABLE subscription_type_members (
+            subscription_id INTEGER NOT NULL,
+            type_key TEXT NOT NULL,
+            PRIMARY KEY (subscription_id, type_key)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        INSERT INTO subscription_type_members (subscription_id, type_key)
+        SELECT id, subscription_type FROM subscriptions WHERE subscription_type IS NOT NULL
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_members_insert
+        AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT OR IGNORE INTO subscription_type_members (subscription_id, type_key)
+            SELECT NEW.id, value FROM json_each(COALESCE(NEW.type_keys, json_array(NEW.subscription_type)))
+            WHERE value IS NOT NULL;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_members_update
+        AFTER UPDATE OF type_keys, subscription_type ON subscriptions
+        WHEN OLD.type_keys IS NOT NEW.type_keys OR OLD.subscription_type IS NOT NEW.subscription_type
+        BEGIN
+            DELETE FROM subscription_type_members
+            WHERE subscription_id = NEW.id AND type_key NOT IN (
+                SELECT value FROM json_each(COALESCE(NEW.type_keys, json_array(NEW.subscription_type)))
+                WHERE value IS NOT NULL
+            );
+            INSERT OR IGNORE INTO subscription_type_members (subscription_id, type_key)
+            SELECT NEW.id, value FROM json_each(COALESCE(NEW.type_keys, json_array(NEW.subscription_type)))
+            WHERE value IS NOT NULL;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_members_delete
+        AFTER DELETE ON subscriptions
+        BEGIN
+            DELETE FROM subscription_type_members WHERE subscription_id = OLD.id;
+        END
+    ''')
+
+    # Журнал изменений подписок для копий в памяти (см. changes.py)
+    c.execute('''
+        CREATE TABLE subscription_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            subscription_id INTEGER NOT NULL,
+            changed_at INTEGER NOT NULL DEFAULT (strftime('%s', 'now'))
+        )
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_changes_insert
+        AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT INTO subscription_changes (subscription_id) VALUES (NEW.id);
+        END
+    ''')
+    # Счетчики доставки (failure_count, last_*_at) в журнал не попадают
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_changes_update
+        AFTER UPDATE OF endpoint, auth_key, p256dh_key, subscription_type, type_keys ON subscriptions
+        BEGIN
+            INSERT INTO subscription_changes (subscription_id) VALUES (NEW.id);
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER trg_subscriptions_changes_delete
+        AFTER DELETE ON subscriptions
+        BEGIN
+            INSERT INTO subscription_changes (subscription_id) VALUES (OLD.id);
+        END
+    ''')
+
+    # Фоновые и отложенные рассылки (см. jobs.py, scheduler.py)
+    c.execute('''
+        CREATE TABLE dispatch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            target_type TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            deleted INTEGER DEFAULT 0,
+            error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            started_at DATETIME,
+            finished_at DATETIME,
+            send_at REAL,
+            ttl INTEGER,
+            topic TEXT,
+            urgency TEXT
+        )
+    ''')
+    # Ближайшие отложенные рассылки для планировщика
+    c.execute("CREATE INDEX idx_dispatch_jobs_scheduled ON dispatch_jobs (send_at) WHERE status = 'scheduled'")
+    # Поиск незавершенных рассылок той же аудитории и темы для замены
+    c.execute("CREATE INDEX idx_dispatch_jobs_topic ON dispatch_jobs (topic, target_type) WHERE topic IS NOT NULL")
+    # Части рассылки по диапазонам subscription_id; ahead - пачки,
+    # завершенные после cursor (JSON [[первый id, последний id], ...])
+    c.execute('''
+        CREATE TABLE dispatch_shards (
+            job_id INTEGER NOT NULL,
+            shard INTEGER NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            worker TEXT,
+            lease_until REAL,
+            error TEXT,
+            cursor INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            retry_at REAL,
+            handled INTEGER NOT NULL DEFAULT 0,
+            ahead TEXT,
+            PRIMARY KEY (job_id, shard)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX idx_dispatch_shards_status ON dispatch_shards (status, lease_until)")
+
+    # Журнал доставки по подписчикам и сводка по рассылкам (см. deliveries.py)
+    c.execute('''
+        CREATE TABLE deliveries (
+            id INTEGER PRIMARY KEY,
+            job_id INTEGER NOT NULL,
+            subscription_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            http_status INTEGER,
+            latency_ms INTEGER,
+            requests INTEGER NOT NULL,
+            delivered_at INTEGER NOT NULL
+        )
+    ''')
+    # Индекс по job_id упорядочен и по id, поэтому страницы рассылки идут по нему
+    c.execute("CREATE INDEX idx_deliveries_job ON deliveries (job_id)")
+    c.execute("CREATE INDEX idx_deliveries_subscription ON deliveries (subscription_id)")
+    # Сводка переживает очистку журнала; http_status 0 - ответа не было
+    c.execute('''
+        CREATE TABLE delivery_rollups (
+            job_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            http_status INTEGER NOT NULL,
+            deliveries INTEGER NOT NULL,
+            latency_ms_sum INTEGER NOT NULL,
+            latency_ms_max INTEGER NOT NULL,
+            PRIMARY KEY (job_id, status, http_status)
+        ) WITHOUT ROWID
+    ''')
+
+
+MIGRATIONS = [
+    migration_1_baseline,
+    migration_2_dispatch,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Применить недостающие миграции. Возвращает число выполненных"""
+    if get_version(conn) >= SCHEMA_VERSION:
+        return 0
+
+    busy_timeout = conn.execute("PRAGMA busy_timeout").fetchone()[0]
+    conn.execute(f"PRAGMA busy_timeout = {int(MIGRATION_LOCK_TIMEOUT * 1000)}")
+    try:
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Пока ждали блокировку, миграции мог выполнить другой процесс
+            version = get_version(conn)
+            for number in range(version + 1, SCHEMA_VERSION + 1):
+                MIGRATIONS[number - 1](conn)
+                logger.info("Миграция применена", extra={"fields": {
+                    "version": number, "name": MIGRATIONS[number - 1].__name__
+                }})
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute(f"PRAGMA busy_timeout = {busy_timeout}")
+    return max(0, SCHEMA_VERSION - version)
+
+
+def drop_all(conn):
+    """Удалить все таблицы и сбросить версию схемы (для /api/debug/reset-db)"""
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    )]
+    with conn:
+        for table in tables:
+            conn.execute(f'DROP TABLE IF EXISTS "{table}"')
+        conn.execute("PRAGMA user_version = 0")
@@ -0,0 +1,117 @@
+import os
+import asyncio
+import logging
+
+from metrics import current_endpoint
+from deliveries import trim_deliveries
+
+logger = logging.getLogger(__name__)
+
+# Настройки очистки неактивных подписок
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "3600"))
+SWEEP_MAX_FAILURES = int(os.getenv("SWEEP_MAX_FAILURES", "5"))
+SWEEP_STALE_DAYS = int(os.getenv("SWEEP_STALE_DAYS", "7"))
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", "1000"))
+# Сколько хранить журнал изменений подписок (секунды)
+SUBSCRIPTION_CHANGES_RETENTION = int(os.getenv("SUBSCRIPTION_CHANGES_RETENTION", "3600"))
+
+
+def record_batch_results(conn, batch):
+    """Сохранить результаты отправки пачки (без commit, в транзакции вызывающего).
+
+    Подписки, которые push-сервис считает удаленными (404/410), удаляются
+    одним executemany, у остальных обновляются счетчики ошибок и время
+    последней успешной доставки. Счетчик ошибок растет только от отказов
+    из-за самой подписки (batch.rejected_ids): ошибки сервера (VAPID,
+    размер payload, перегрузка push-сервиса) не должны приводить к очистке.
+    """
+    c = conn.cursor()
+    if batch.expired_ids:
+        c.executemany(
+            "DELETE FROM subscriptions WHERE id = ?",
+            [(sub_id,) for sub_id in batch.expired_ids]
+        )
+    if batch.sent_ids:
+        c.executemany(
+            "UPDATE subscriptions SET failure_count = 0, last_success_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(sub_id,) for sub_id in batch.sent_ids]
+        )
+    if batch.rejected_ids:
+        c.executemany(
+            "UPDATE subscriptions SET failure_count = failure_count + 1, last_failure_at = CURRENT_TIMESTAMP WHERE id = ?",
+            [(sub_id,) for sub_id in batch.rejected_ids]
+        )
+
+
+def sweep_failed_subscriptions(conn, max_failures=SWEEP_MAX_FAILURES,
+                               stale_days=SWEEP_STALE_DAYS, batch_size=SWEEP_BATCH_SIZE):
+    """Удалить подписки, которые подряд не доставлялись max_failures раз
+    и не получали уведомлений stale_days дней.
+
+    Удаление идет порциями по batch_size, каждая в своей транзакции, чтобы
+    не держать блокировку записи долго. Возвращает число удаленных подписок.
+    """
+    deleted = 0
+    while True:
+        with conn:
+            c = conn.execute("""
+                DELETE FROM subscriptions WHERE id IN (
+                    SELECT id FROM subscriptions
+                    WHERE failure_count >= ?
+                      AND (last_success_at IS NULL OR last_success_at < datetime('now', ?))
+                    LIMIT ?
+                )
+            """, (max_failures, f"-{stale_days} days", batch_size))
+        deleted += c.rowcount
+        if c.rowcount < batch_size:
+            return deleted
+
+
+def trim_subscription_changes(conn, retention=SUBSCRIPTION_CHANGES_RETENTION):
+    """Удалить старые записи журнала изменений подписок. Процесс, который
+    не успел их прочитать, загрузит снимок аудитории заново"""
+    with conn:
+        return conn.execute(
+            "DELETE FROM subscription_changes WHERE changed_at < CAST(strftime('%s', 'now') AS INTEGER) - ?",
+            (retention,)
+        ).rowcount
+
+
+class Sweeper:
+    """Фоновая периодическая очистка подписок, которые перестали доставляться,
+    и старых записей журналов"""
+
+    def __init__(self, db, interval=SWEEP_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._task = None
+
+    async def sweep(self):
+        """Выполнить очистку сейчас. Возвращает число удаленных подписок"""
+        deleted = await self.db.run(sweep_failed_subscriptions)
+        if deleted:
+            logger.info("Удалены неактивные подписки", extra={"fields": {"deleted": deleted}})
+        await self.db.run(trim_subscription_changes)
+        trimmed = await self.db.run(trim_deliveries)
+        if trimmed:
+            logger.info("Удалены старые записи журнала доставки", extra={"fields": {"deleted": trimmed}})
+        return deleted
+
+    async def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        current_endpoint.set("sweeper")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Ошибка очистки подписок")
@@ -0,0 +1,597 @@
+import os
+import re
+import time
+import base64
+import random
+import asyncio
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import aiohttp
+import http_ece
+from cryptography.hazmat.primitives.asymmetric import ec
+from py_vapid import Vapid
+
+from logging_setup import log_subscriber
+from metrics import (PUSH_RESULTS, PUSH_RETRIES, PUSH_LATENCY, PUSH_IN_FLIGHT,
+                     ENCRYPT_LATENCY, ENCRYPTED_MESSAGES)
+
+logger = logging.getLogger(__name__)
+
+# Настройки параллельной рассылки
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "200"))
+PUSH_CONNECTIONS_PER_HOST = int(os.getenv("PUSH_CONNECTIONS_PER_HOST", "100"))
+PUSH_TIMEOUT = float(os.getenv("PUSH_TIMEOUT", "10"))
+PUSH_KEEPALIVE_TIMEOUT = float(os.getenv("PUSH_KEEPALIVE_TIMEOUT", "60"))
+
+# Адаптивный лимит одновременных запросов к каждому push-сервису (AIMD)
+PUSH_HOST_INITIAL_LIMIT = int(os.getenv("PUSH_HOST_INITIAL_LIMIT", "20"))
+PUSH_HOST_MIN_LIMIT = int(os.getenv("PUSH_HOST_MIN_LIMIT", "1"))
+PUSH_LATENCY_TARGET = float(os.getenv("PUSH_LATENCY_TARGET", "1.0"))
+PUSH_LIMIT_BACKOFF = float(os.getenv("PUSH_LIMIT_BACKOFF", "0.5"))
+
+# Повторы при 429/5xx и сетевых ошибках
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "5"))
+PUSH_RETRY_BASE_DELAY = float(os.getenv("PUSH_RETRY_BASE_DELAY", "1"))
+PUSH_RETRY_MAX_DELAY = float(os.getenv("PUSH_RETRY_MAX_DELAY", "300"))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Отказы из-за самой подписки (а не ключа VAPID, размера payload или
+# перегрузки сервиса) - только они считаются в failure_count для очистки
+SUBSCRIPTION_ERROR_STATUSES = {400}
+
+# Шифрование payload в пуле процессов (0 - шифровать в потоке без пула).
+# По умолчанию ядра делятся между воркерами uvicorn (WEB_CONCURRENCY)
+ENCRYPT_PROCESSES = int(os.getenv(
+    "ENCRYPT_PROCESSES",
+    str(max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1"))))
+))
+ENCRYPT_CHUNK_SIZE = int(os.getenv("ENCRYPT_CHUNK_SIZE", "64"))
+
+# Параметры Web Push (RFC 8030): TTL по умолчанию (0 - только онлайн-устройствам),
+# допустимые Urgency и формат Topic
+PUSH_DEFAULT_TTL = int(os.getenv("PUSH_DEFAULT_TTL", "0"))
+PUSH_MAX_TTL = 28 * 24 * 60 * 60
+URGENCY_VALUES = ("very-low", "low", "normal", "high")
+TOPIC_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+# Срок жизни VAPID JWT и запас до exp, после которого подпись обновляется
+VAPID_TOKEN_TTL = int(os.getenv("VAPID_TOKEN_TTL", str(12 * 60 * 60)))
+VAPID_REFRESH_MARGIN = int(os.getenv("VAPID_REFRESH_MARGIN", "300"))
+
+
+def get_push_service(endpoint):
+    """Определить хост push-сервиса (FCM, Mozilla autopush, Apple) по endpoint"""
+    try:
+        return endpoint.split('/')[2]
+    except (AttributeError, IndexError):
+        return "unknown"
+
+
+def get_audience(endpoint):
+    """Origin push-сервиса для VAPID claim 'aud'"""
+    parsed_url = urlparse(endpoint)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}"
+
+
+def push_headers(ttl=None, topic=None, urgency=None):
+    """Заголовки Web Push для рассылки. Push-сервис хранит сообщение TTL
+    секунд, заменяет недоставленное сообщение с тем же Topic новым и по
+    Urgency решает, будить ли устройство. ValueError при недопустимом значении"""
+    ttl = PUSH_DEFAULT_TTL if ttl is None else ttl
+    if not isinstance(ttl, int) or isinstance(ttl, bool) or not 0 <= ttl <= PUSH_MAX_TTL:
+        raise ValueError(f"ttl: целое число секунд от 0 до {PUSH_MAX_TTL}")
+    headers = {"TTL": str(ttl)}
+    if topic is not None:
+        if not isinstance(topic, str) or not TOPIC_PATTERN.fullmatch(topic):
+            raise ValueError("topic: до 32 символов A-Z a-z 0-9 _ -")
+        headers["Topic"] = topic
+    if urgency is not None:
+        if urgency not in URGENCY_VALUES:
+            raise ValueError(f"urgency: одно из {', '.join(URGENCY_VALUES)}")
+        headers["Urgency"] = urgency
+    return headers
+
+
+def parse_retry_after(value):
+    """Retry-After в секундах (число секунд или HTTP-дата), None если не задан"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt, retry_after=None):
+    """Экспоненциальная задержка перед повтором с jitter, не меньше Retry-After"""
+    delay = min(PUSH_RETRY_MAX_DELAY, PUSH_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    delay = random.uniform(delay / 2, delay)
+    if retry_after:
+        delay = max(delay, min(retry_after, PUSH_RETRY_MAX_DELAY))
+    return delay
+
+
+def _b64decode(value):
+    """base64url без padding -> bytes"""
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def encrypt_batch(subscribers, payload):
+    """Зашифровать payload (aes128gcm) для пачки подписчиков.
+
+    Выполняется в процессе пула. subscribers - список пар (p256dh_key, auth_key),
+    результат - список пар (body, error) в том же порядке.
+    """
+    data = payload.encode("utf8")
+    results = []
+    for p256dh_key, auth_key in subscribers:
+        try:
+            # Эфемерный ECDH ключ сервера - свой для каждого сообщения
+            server_key = ec.generate_private_key(ec.SECP256R1())
+            body = http_ece.encrypt(
+                data,
+                private_key=server_key,
+                dh=_b64decode(p256dh_key),
+                auth_secret=_b64decode(auth_key),
+                version="aes128gcm"
+            )
+            results.append((body, None))
+        except Exception as e:
+            results.append((None, str(e)))
+    return results
+
+
+class VapidHeaderCache:
+    """Кэш подписанных VAPID-заголовков Authorization по audience push-сервиса.
+
+    Ключ разбирается один раз, а JWT для каждого origin подписывается заново
+    только когда до exp остается меньше VAPID_REFRESH_MARGIN секунд.
+    """
+
+    def __init__(self, vapid_private_key, vapid_claims,
+                 token_ttl=VAPID_TOKEN_TTL, refresh_margin=VAPID_REFRESH_MARGIN):
+        self.vapid_claims = vapid_claims
+        self.token_ttl = token_ttl
+        self.refresh_margin = refresh_margin
+        self.vapid = Vapid.from_string(private_key=vapid_private_key)
+        self._headers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, audience):
+        """Заголовки Authorization для origin push-сервиса"""
+        now = int(time.time())
+        cached = self._headers.get(audience)
+        if cached and cached[0] - self.refresh_margin > now:
+            self.hits += 1
+            return cached[1]
+        
+        self.misses += 1
+        claims = dict(self.vapid_claims, aud=audience, exp=now + self.token_ttl)
+        headers = self.vapid.sign(claims)
+        self._headers[audience] = (claims["exp"], headers)
+        return headers
+
+    def stats(self):
+        return {
+            "audiences": len(self._headers),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class AdaptiveLimiter:
+    """Лимит одновременных запросов к одному push-сервису.
+
+    Лимит растет на 1/limit после каждого быстрого успешного ответа (примерно
+    +1 за круг запросов) и умножается на PUSH_LIMIT_BACKOFF при 429/5xx,
+    сетевой ошибке или задержке выше PUSH_LATENCY_TARGET - не чаще раза
+    за PUSH_LATENCY_TARGET, чтобы одна волна ошибок не обнулила лимит.
+    Retry-After блокирует сервис до указанного времени.
+    """
+
+    def __init__(self, initial=PUSH_HOST_INITIAL_LIMIT, min_limit=PUSH_HOST_MIN_LIMIT,
+                 max_limit=PUSH_CONNECTIONS_PER_HOST, latency_target=PUSH_LATENCY_TARGET):
+        self.min_limit = max(min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._waiters = deque()
+
+    def blocked_for(self):
+        """Сколько секунд ещё действует Retry-After"""
+        return max(self.blocked_until - time.monotonic(), 0.0)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Нас разбудили, но задачу отменили - место отдаем следующему
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def record(self, latency, congested):
+        """Учесть результат запроса: сигнал перегрузки или быстрый успех"""
+        now = time.monotonic()
+        if congested or latency > self.latency_target:
+            if now - self._last_decrease >= self.latency_target:
+                self.limit = max(self.min_limit, self.limit * PUSH_LIMIT_BACKOFF)
+                self._last_decrease = now
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "blocked_for": round(self.blocked_for(), 2)
+        }
+
+
+class BatchResult:
+    """Итоги отправки одной пачки подписчиков"""
+
+    def __init__(self, subscriptions):
+        self.subscriptions = subscriptions
+        self.pending = len(subscriptions)
+        self.sent_ids = []
+        self.failed_ids = []
+        self.expired_ids = []
+        # Часть failed_ids, в которой виновата сама подписка (ключи, 400)
+        self.rejected_ids = []
+        # (id, результат, HTTP-статус, задержка в секундах, число запросов) по подписчикам
+        self.deliveries = []
+
+    @property
+    def sent(self):
+        return len(self.sent_ids)
+
+    @property
+    def failed(self):
+        return len(self.failed_ids) + len(self.expired_ids)
+
+
+class PushItem:
+    """Зашифрованное сообщение одному подписчику"""
+
+    __slots__ = ("batch", "sub", "body", "error", "attempts", "requests", "http_status", "latency")
+
+    def __init__(self, batch, sub, body, error):
+        self.batch = batch
+        self.sub = sub
+        self.body = body
+        self.error = error
+        self.attempts = 0
+        # Последний ответ push-сервиса (для журнала доставки)
+        self.requests = 0
+        self.http_status = None
+        self.latency = None
+
+
+class BroadcastRun:
+    """Состояние одной рассылки: очередь готовых сообщений, отложенные
+    повторы и незавершенные пачки"""
+
+    def __init__(self, queue_size, on_batch_done, headers):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.on_batch_done = on_batch_done
+        self.headers = headers
+        self.totals = {"sent": 0, "failed": 0, "expired": 0, "retried": 0}
+        self.open_batches = 0
+        self.encrypt_done = False
+        self.finished = asyncio.Event()
+        self.retry_tasks = set()
+
+    def retry_later(self, item, delay):
+        """Вернуть сообщение в очередь через delay секунд"""
+        async def requeue():
+            await asyncio.sleep(delay)
+            await self.queue.put(item)
+
+        task = asyncio.ensure_future(requeue())
+        self.retry_tasks.add(task)
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def complete(self, item, status, rejected=False):
+        """Зафиксировать окончательный результат для подписчика. rejected -
+        отказ из-за самой подписки (см. BatchResult.rejected_ids)"""
+        batch = item.batch
+        batch.deliveries.append((item.sub['id'], status, item.http_status, item.latency, item.requests))
+        if status == "sent":
+            batch.sent_ids.append(item.sub['id'])
+        elif status == "expired":
+            batch.expired_ids.append(item.sub['id'])
+        else:
+            batch.failed_ids.append(item.sub['id'])
+            if rejected:
+                batch.rejected_ids.append(item.sub['id'])
+        batch.pending -= 1
+        if batch.pending == 0:
+            self.totals["sent"] += batch.sent
+            self.totals["failed"] += batch.failed
+            self.totals["expired"] += len(batch.expired_ids)
+            if self.on_batch_done is not None:
+                await self.on_batch_done(batch)
+            self.open_batches -= 1
+            self.check_finished()
+
+    def check_finished(self):
+        if self.encrypt_done and self.open_batches == 0:
+            self.finished.set()
+
+
+class PushSender:
+    """Рассылка уведомлений конвейером из двух стадий.
+
+    Шифрование payload выполняется пачками в пуле процессов на всех ядрах,
+    готовые тела сообщений через ограниченную очередь передаются сетевой стадии.
+    Сетевая стадия держит не больше `concurrency` запросов одновременно, а к
+    каждому push-сервису - не больше его адаптивного лимита (AdaptiveLimiter).
+    429/5xx и сетевые ошибки не считаются отказом: сообщение повторяется позже
+    с экспоненциальной задержкой и учетом Retry-After. Все запросы идут через
+    одну aiohttp-сессию, поэтому keep-alive соединения к каждому push-сервису
+    переиспользуются между подписчиками и рассылками.
+    """
+
+    def __init__(self, vapid_private_key, vapid_claims,
+                 concurrency=PUSH_CONCURRENCY,
+                 connections_per_host=PUSH_CONNECTIONS_PER_HOST,
+                 timeout=PUSH_TIMEOUT,
+                 encrypt_processes=ENCRYPT_PROCESSES,
+                 encrypt_chunk_size=ENCRYPT_CHUNK_SIZE,
+                 max_retries=PUSH_MAX_RETRIES):
+        self.vapid_private_key = vapid_private_key
+        self.vapid_claims = vapid_claims
+        self.concurrency = concurrency
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.encrypt_processes = encrypt_processes
+        self.encrypt_chunk_size = encrypt_chunk_size
+        self.max_retries = max_retries
+        self.session = None
+        self.vapid_cache = None
+        self.encrypt_pool = None
+        self.limiters = {}
+        self.runs = set()
+
+    async def start(self):
+        """Разобрать VAPID ключ, создать пул HTTP-соединений и пул шифрования"""
+        if self.vapid_cache is None and self.vapid_private_key:
+            self.vapid_cache = VapidHeaderCache(self.vapid_private_key, self.vapid_claims)
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                limit_per_host=self.connections_per_host,
+                keepalive_timeout=PUSH_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        if self.encrypt_pool is None and self.encrypt_processes > 0:
+            # spawn: дочерние процессы не наследуют потоки и event loop сервера
+            self.encrypt_pool = ProcessPoolExecutor(
+                max_workers=self.encrypt_processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+
+    async def close(self):
+        """Закрыть пул HTTP-соединений и пул шифрования"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.encrypt_pool is not None:
+            self.encrypt_pool.shutdown(wait=False, cancel_futures=True)
+            self.encrypt_pool = None
+
+    def get_limiter(self, service):
+        limiter = self.limiters.get(service)
+        if limiter is None:
+            limiter = self.limiters[service] = AdaptiveLimiter(max_limit=self.connections_per_host)
+        return limiter
+
+    def limiter_stats(self):
+        return {service: limiter.stats() for service, limiter in self.limiters.items()}
+
+    def queue_stats(self):
+        """Сообщения, ожидающие отправки, и отложенные повторы по всем текущим рассылкам"""
+        return {
+            "queued": sum(run.queue.qsize() for run in self.runs),
+            "retry_pending": sum(len(run.retry_tasks) for run in self.runs)
+        }
+
+    async def _encrypt_chunk(self, chunk, payload):
+        keys = [(sub['p256dh_key'], sub['auth_key']) for sub in chunk]
+        started = time.monotonic()
+        try:
+            if self.encrypt_pool is None:
+                return await asyncio.to_thread(encrypt_batch, keys, payload)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.encrypt_pool, encrypt_batch, keys, payload)
+        finally:
+            ENCRYPT_LATENCY.observe(time.monotonic() - started)
+            ENCRYPTED_MESSAGES.inc(amount=len(keys))
+
+    async def _encrypt_stage(self, batches, payload, run):
+        """Шифровать пачки параллельно и складывать готовые сообщения в очередь.
+
+        Следующая страница подписчиков читается, пока отправляются предыдущие;
+        очередь и число шифруемых пачек ограничены, поэтому память не растет
+        вместе с размером аудитории.
+        """
+        max_in_flight = max(self.encrypt_processes, 1) * 2
+        in_flight = {}
+
+        async def drain():
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                batch, chunk = in_flight.pop(task)
+                for sub, (body, error) in zip(chunk, task.result()):
+                    await run.queue.put(PushItem(batch, sub, body, error))
+
+        try:
+            async for subscriptions in batches:
+                batch = BatchResult(subscriptions)
+                run.open_batches += 1
+                for start in range(0, len(subscriptions), self.encrypt_chunk_size):
+                    chunk = subscriptions[start:start + self.encrypt_chunk_size]
+                    task = asyncio.ensure_future(self._encrypt_chunk(chunk, payload))
+                    in_flight[task] = (batch, chunk)
+                    if len(in_flight) >= max_in_flight:
+                        await drain()
+            while in_flight:
+                await drain()
+        finally:
+            for task in in_flight:
+                task.cancel()
+        run.encrypt_done = True
+        run.check_finished()
+
+    async def _deliver(self, sub, body, extra_headers):
+        """Отправить одно зашифрованное сообщение с заголовками extra_headers (TTL, Topic, Urgency).
+
+        Возвращает (status, http_status, retry_after), где status - "sent",
+        "expired", "retry" (временная ошибка) или "failed".
+        """
+        try:
+            if self.vapid_cache is None:
+                raise RuntimeError("VAPID_PRIVATE_KEY не задан")
+            headers = dict(self.vapid_cache.get(get_audience(sub['endpoint'])))
+            headers["Content-Encoding"] = "aes128gcm"
+            headers.update(extra_headers)
+            async with self.session.post(sub['endpoint'], data=body, headers=headers) as response:
+                if response.status <= 202:
+                    return "sent", response.status, None
+                text = await response.text()
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if response.status in RETRYABLE_STATUSES:
+                return "retry", response.status, retry_after
+            if response.status in (404, 410):
+                log_subscriber(logger, logging.INFO, "Подписка больше не существует",
+                               subscription_id=sub['id'], status=response.status)
+                return "expired", response.status, None
+            log_subscriber(logger, logging.WARNING, "Push-сервис отклонил уведомление",
+                           subscription_id=sub['id'], status=response.status, response=text[:200])
+            return "failed", response.status, None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return "retry", None, None
+        except Exception as e:
+            log_subscriber(logger, logging.WARNING, "Неизвестная ошибка отправки",
+                           subscription_id=sub['id'], error=repr(e))
+            return "failed", None, None
+
+    async def _sender(self, run):
+        while True:
+            item = await run.queue.get()
+            service = get_push_service(item.sub['endpoint'])
+            if item.error is not None:
+                log_subscriber(logger, logging.WARNING, "Ошибка шифрования",
+                               subscription_id=item.sub['id'], error=item.error)
+                PUSH_RESULTS.inc(service, item.sub['subscription_type'], "failed")
+                # Ключи подписки не подходят для шифрования
+                await run.complete(item, "failed", rejected=True)
+                continue
+
+            limiter = self.get_limiter(service)
+            blocked_for = limiter.blocked_for()
+            if blocked_for > 0:
+                # Сервис просил подождать (Retry-After) - откладываем, не занимая отправителя
+                run.retry_later(item, blocked_for + random.uniform(0, PUSH_RETRY_BASE_DELAY))
+                continue
+
+            await limiter.acquire()
+            PUSH_IN_FLIGHT.inc()
+            started = time.monotonic()
+            try:
+                status, http_status, retry_after = await self._deliver(item.sub, item.body, run.headers)
+            finally:
+                limiter.release()
+                PUSH_IN_FLIGHT.dec()
+            latency = time.monotonic() - started
+            item.requests += 1
+            item.http_status = http_status
+            item.latency = latency
+            limiter.record(latency, congested=(status == "retry"))
+            PUSH_LATENCY.observe(latency, service)
+
+            if status == "retry":
+                item.attempts += 1
+                if retry_after:
+                    limiter.block(min(retry_after, PUSH_RETRY_MAX_DELAY))
+                if item.attempts <= self.max_retries:
+                    run.totals["retried"] += 1
+                    PUSH_RETRIES.inc(service)
+                    run.retry_later(item, retry_delay(item.attempts, retry_after))
+                    continue
+                log_subscriber(logger, logging.WARNING, "Попытки доставки исчерпаны",
+                               subscription_id=item.sub['id'], status=http_status, attempts=item.attempts)
+                status = "failed"
+            elif status == "sent":
+                log_subscriber(logger, logging.DEBUG, "Уведомление доставлено",
+                               subscription_id=item.sub['id'], status=http_status)
+            PUSH_RESULTS.inc(service, item.sub['subscription_type'], status)
+            # Исчерпанные повторы и локальные ошибки (http_status None) подписку не порочат
+            await run.complete(item, status, rejected=status == "failed" and http_status in SUBSCRIPTION_ERROR_STATUSES)
+
+    async def broadcast(self, batches, payload, on_batch_done=None, headers=None):
+        """Разослать уведомление подписчикам из потока пачек.
+
+        batches - асинхронный итератор списков подписчиков. Когда по всем
+        подписчикам пачки получен окончательный результат (с учетом повторов),
+        вызывается on_batch_done(BatchResult). headers - заголовки Web Push
+        (push_headers), по умолчанию только TTL. Возвращает общие счетчики.
+        """
+        await self.start()
+        run = BroadcastRun(self.concurrency * 2, on_batch_done, headers or push_headers())
+        self.runs.add(run)
+        tasks = [asyncio.ensure_future(self._encrypt_stage(batches, payload, run))]
+        tasks += [asyncio.ensure_future(self._sender(run)) for _ in range(self.concurrency)]
+        finished = asyncio.ensure_future(run.finished.wait())
+        try:
+            while not run.finished.is_set():
+                done, _ = await asyncio.wait([finished, *tasks], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is not finished and task.exception() is not None:
+                        raise task.exception()
+                tasks = [task for task in tasks if not task.done()]
+        finally:
+            # Отправители работают до конца рассылки; при ошибке или отмене
+            # не оставляем висящих стадий конвейера и отложенных повторов
+            for task in [finished, *tasks, *run.retry_tasks]:
+                task.cancel()
+            self.runs.discard(run)
+        return run.totals
@@ -0,0 +1,99 @@
+"""Планировщик отложенных рассылок.
+
+Отложенная рассылка хранится в dispatch_jobs (status='scheduled', send_at),
+поэтому переживает перезапуск. В памяти процесса - куча (send_at, job_id)
+ближайших задач: таймер спит до вершины кучи, а не опрашивает БД каждую
+секунду. Задачи, запланированные этим процессом, попадают в кучу сразу;
+остальные (другие воркеры, задачи до перезапуска) подгружаются раз
+в SCHEDULER_POLL_INTERVAL по частичному индексу, только те, чей срок
+наступит до следующего опроса.
+
+Наступившую задачу ставит в очередь один процесс: Dispatcher.activate
+меняет статус условным UPDATE, остальные получают None. Заменённые
+(superseded) задачи остаются в куче и пропускаются при срабатывании.
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+
+from metrics import current_endpoint
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "5"))
+
+
+class Scheduler:
+    """Запуск отложенных рассылок в срок"""
+
+    def __init__(self, db, dispatcher, poll_interval=SCHEDULER_POLL_INTERVAL):
+        self.db = db
+        self.dispatcher = dispatcher
+        self.poll_interval = poll_interval
+        self.heap = []
+        self._queued = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def _due_jobs(self, conn, until):
+        return conn.execute(
+            "SELECT send_at, id FROM dispatch_jobs WHERE status = 'scheduled' AND send_at <= ?",
+            (until,)
+        ).fetchall()
+
+    def _push(self, send_at, job_id):
+        if job_id in self._queued:
+            return
+        self._queued.add(job_id)
+        heapq.heappush(self.heap, (send_at, job_id))
+        if self.heap[0][1] == job_id:
+            # Новая ближайшая задача - таймер нужно перезавести
+            self._wakeup.set()
+
+    async def schedule(self, target_type, payload, send_at, **options):
+        """Сохранить отложенную рассылку. Возвращает (job_id, число замененных задач)"""
+        job_id, superseded = await self.dispatcher.schedule(target_type, payload, send_at, **options)
+        self._push(send_at, job_id)
+        return job_id, superseded
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _activate(self, send_at, job_id):
+        total = await self.dispatcher.activate(job_id)
+        if total is not None:
+            logger.info("Отложенная рассылка поставлена в очередь", extra={"fields": {
+                "job_id": job_id, "total": total, "delay_s": round(time.time() - send_at, 3)
+            }})
+
+    async def _run(self):
+        current_endpoint.set("scheduler")
+        next_poll = 0
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            try:
+                if now >= next_poll:
+                    next_poll = now + self.poll_interval
+                    for send_at, job_id in await self.db.run(self._due_jobs, next_poll):
+                        self._push(send_at, job_id)
+                while self.heap and self.heap[0][0] <= time.time():
+                    send_at, job_id = heapq.heappop(self.heap)
+                    self._queued.discard(job_id)
+                    await self._activate(send_at, job_id)
+            except Exception:
+                logger.exception("Ошибка запуска отложенных рассылок")
+            wake_at = min(next_poll, self.heap[0][0]) if self.heap else next_poll
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0, wake_at - time.time()))
+            except asyncio.TimeoutError:
+                pass
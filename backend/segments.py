@@ -0,0 +1,286 @@
+"""Сегменты аудитории: битовые карты подписчиков по типам и выражения таргетинга.
+
+Подписка может входить в несколько типов (subscription_type_members). Для
+каждого типа процесс держит битовую карту id подписчиков - целое число
+Python, в котором бит N означает подписку с id N (id выдаются подряд,
+поэтому карта плотная: 125 КБ на тип при id до миллиона). Выражение
+таргетинга вычисляется побитовыми операциями над картами без SQL и
+разворачивается в поток id получателей по возрастанию. Карты обновляются по
+журналу subscription_changes (см. changes.JournalMirror).
+
+Синтаксис выражений: ключи типов, all (все подписчики), | или OR, & или AND,
+! или NOT, скобки. NOT связывает сильнее AND, AND - сильнее OR:
+
+    news                         подписчики news
+    news | promo                 news или promo (каждый получатель один раз)
+    (news | promo) & !urgent     news или promo, но не urgent
+    news AND promo               подписанные на оба типа
+"""
+import os
+import re
+from functools import reduce
+from itertools import combinations
+from operator import and_, or_
+
+from changes import JournalMirror, fetch_by_ids
+
+SEGMENTS_SYNC_INTERVAL = float(os.getenv("SEGMENTS_SYNC_INTERVAL", "1"))
+
+_TOKEN = re.compile(r"\s*(?:([()|&!])|([\w.-]+))")
+_KEYWORDS = {"or": "|", "and": "&", "not": "!"}
+RESERVED_KEYS = {"all", *_KEYWORDS}
+# Номера установленных битов для каждого значения байта
+_BIT_POSITIONS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+# ---------- Выражения таргетинга ----------
+
+def valid_type_key(type_key):
+    """Ключ типа можно использовать в выражениях таргетинга"""
+    return re.fullmatch(r"[\w.-]+", type_key) is not None and type_key.lower() not in RESERVED_KEYS
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f"Недопустимый символ в выражении: {text[position:].strip()[:20]!r}")
+        operator, name = match.groups()
+        if name is not None and name.lower() in _KEYWORDS:
+            operator, name = _KEYWORDS[name.lower()], None
+        tokens.append(operator or name)
+        position = match.end()
+    return tokens
+
+
+def parse_target(text):
+    """Разобрать выражение в дерево: ("all",), ("type", key), ("not", x),
+    ("and", x, y, ...), ("or", x, y, ...). ValueError при ошибке"""
+    if not isinstance(text, str):
+        raise ValueError("targetType должен быть строкой")
+    tokens = _tokenize(text)
+    position = 0
+
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+
+    def take():
+        nonlocal position
+        token = peek()
+        if token is None:
+            raise ValueError("Неожиданный конец выражения")
+        position += 1
+        return token
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == "|":
+            take()
+            children.append(parse_and())
+        return children[0] if len(children) == 1 else ("or", *children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() == "&":
+            take()
+            children.append(parse_not())
+        return children[0] if len(children) == 1 else ("and", *children)
+
+    def parse_not():
+        token = take()
+        if token == "!":
+            return ("not", parse_not())
+        if token == "(":
+            node = parse_or()
+            if take() != ")":
+                raise ValueError("Ожидалась )")
+            return node
+        if token in ("|", "&", ")"):
+            raise ValueError(f"Неожиданный оператор {token!r}")
+        return ("all",) if token.lower() == "all" else ("type", token)
+
+    node = parse_or()
+    if peek() is not None:
+        raise ValueError(f"Лишний фрагмент выражения: {peek()!r}")
+    return node
+
+
+def format_target(node):
+    """Каноническая запись выражения (сохраняется в dispatch_jobs.target_type)"""
+    kind = node[0]
+    if kind == "all":
+        return "all"
+    if kind == "type":
+        return node[1]
+    if kind == "not":
+        inner = format_target(node[1])
+        return f"!{inner}" if node[1][0] in ("all", "type", "not") else f"!({inner})"
+    if kind == "and":
+        return " & ".join(
+            f"({format_target(child)})" if child[0] == "or" else format_target(child)
+            for child in node[1:]
+        )
+    return " | ".join(format_target(child) for child in node[1:])
+
+
+def target_type_keys(node):
+    """Ключи типов, упомянутые в выражении"""
+    if node[0] == "type":
+        return {node[1]}
+    return set().union(*(target_type_keys(child) for child in node[1:]))
+
+
+# ---------- Битовые карты ----------
+
+def bitmap_from_ids(ids):
+    data = bytearray()
+    for sub_id in ids:
+        index = sub_id >> 3
+        if index >= len(data):
+            data.extend(bytes(index - len(data) + 1))
+        data[index] |= 1 << (sub_id & 7)
+    return int.from_bytes(data, "little")
+
+
+def iter_ids(bitmap, after_id=0, last_id=None):
+    """id из битовой карты по возрастанию в диапазоне (after_id, last_id]"""
+    start = after_id + 1
+    if last_id is not None:
+        if last_id < start:
+            return
+        bitmap &= (1 << (last_id + 1)) - 1
+    bitmap >>= start
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    positions = _BIT_POSITIONS
+    for index, byte in enumerate(data):
+        if byte:
+            base = start + index * 8
+            for bit in positions[byte]:
+                yield base + bit
+
+
+def _nth_bit(value, n):
+    """Номер n-го (с 1) установленного бита value"""
+    low, high = 1, value.bit_length()
+    while low < high:
+        middle = (low + high) // 2
+        if (value & ((1 << middle) - 1)).bit_count() >= n:
+            high = middle
+        else:
+            low = middle + 1
+    return low - 1
+
+
+def split_ranges(bitmap, size, block_bytes=4096):
+    """Разбить карту на диапазоны id по size подписчиков (последний - меньше):
+    [(первый id, последний id, число подписчиков)]. Биты считаются блоками
+    по block_bytes, граница внутри блока ищется двоичным поиском"""
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    ranges = []
+    first = last = None
+    count = 0
+    for offset in range(0, len(data), block_bytes):
+        block = int.from_bytes(data[offset:offset + block_bytes], "little")
+        base = offset * 8
+        while block:
+            if first is None:
+                first = base + (block & -block).bit_length() - 1
+            in_block = block.bit_count()
+            if count + in_block < size:
+                last = base + block.bit_length() - 1
+                count += in_block
+                break
+            position = _nth_bit(block, size - count)
+            ranges.append((first, base + position, size))
+            first = None
+            count = 0
+            block &= ~((1 << (position + 1)) - 1)
+    if count:
+        ranges.append((first, last, count))
+    return ranges
+
+
+class SegmentIndex(JournalMirror):
+    """Битовые карты подписчиков по типам в памяти процесса"""
+
+    def __init__(self, db, sync_interval=SEGMENTS_SYNC_INTERVAL):
+        super().__init__(db, sync_interval)
+        self.bitmaps = {}
+        self.all = 0
+        self.version = 0
+        self._stats = None
+
+    def __len__(self):
+        return self.all.bit_count()
+
+    def _load(self, conn):
+        max_id = conn.execute("SELECT MAX(subscription_id) FROM subscription_type_members").fetchone()[0] or 0
+        maps = {}
+        for sub_id, type_key in conn.execute("SELECT subscription_id, type_key FROM subscription_type_members"):
+            data = maps.get(type_key)
+            if data is None:
+                data = maps[type_key] = bytearray(max_id // 8 + 1)
+            data[sub_id >> 3] |= 1 << (sub_id & 7)
+        return {type_key: int.from_bytes(data, "little") for type_key, data in maps.items()}
+
+    def _read(self, conn, ids):
+        return fetch_by_ids(
+            conn, "SELECT subscription_id, type_key FROM subscription_type_members WHERE subscription_id IN ({ids})", ids
+        )
+
+    def _replace(self, bitmaps):
+        self.bitmaps = bitmaps
+        self._changed()
+
+    def _apply(self, ids, rows):
+        added = {}
+        for sub_id, type_key in rows:
+            added.setdefault(type_key, []).append(sub_id)
+        # Биты изменённых подписок сбрасываются во всех картах и ставятся заново
+        keep = ~bitmap_from_ids(ids)
+        for type_key in self.bitmaps.keys() | added.keys():
+            bitmap = self.bitmaps.get(type_key, 0) & keep
+            if type_key in added:
+                bitmap |= bitmap_from_ids(added[type_key])
+            if bitmap:
+                self.bitmaps[type_key] = bitmap
+            else:
+                self.bitmaps.pop(type_key, None)
+        self._changed()
+
+    def _changed(self):
+        self.all = reduce(or_, self.bitmaps.values(), 0)
+        self.version += 1
+        self._stats = None
+
+    # ---------- Чтение ----------
+
+    def evaluate(self, target):
+        """Битовая карта получателей выражения (строка или дерево parse_target)"""
+        node = parse_target(target) if isinstance(target, str) else target
+        kind = node[0]
+        if kind == "all":
+            return self.all
+        if kind == "type":
+            return self.bitmaps.get(node[1], 0)
+        if kind == "not":
+            return self.all & ~self.evaluate(node[1])
+        return reduce(and_ if kind == "and" else or_, (self.evaluate(child) for child in node[1:]))
+
+    def count(self, target):
+        return self.evaluate(target).bit_count()
+
+    def stats(self):
+        """Число подписчиков всего, по типам и в попарных пересечениях типов"""
+        if self._stats is None:
+            counts = {type_key: bitmap.bit_count() for type_key, bitmap in self.bitmaps.items()}
+            overlaps = []
+            for first, second in combinations(sorted(self.bitmaps), 2):
+                common = (self.bitmaps[first] & self.bitmaps[second]).bit_count()
+                if common:
+                    overlaps.append({"types": [first, second], "subscriber_count": common})
+            self._stats = {"total": len(self), "types": counts, "overlaps": overlaps}
+        return self._stats
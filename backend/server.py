@@ -1,18 +1,49 @@
 import os
 import json
+import time
+import logging
 import sqlite3
+from itertools import islice
 from pathlib import Path
-from urllib.parse import urlparse
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
-from pywebpush import webpush, WebPushException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import uvicorn
 
+# Настройки модулей читаются из окружения при импорте
 load_dotenv()
 
-app = FastAPI()
+from logging_setup import setup_logging, log_subscriber
+setup_logging()
+logger = logging.getLogger(__name__)
+
+from db import Database, GroupCommitBuffer
+from push_sender import PushSender, push_headers
+from jobs import Dispatcher
+from scheduler import Scheduler
+from deliveries import (
+    DeliveryLog, DELIVERY_LOG, read_job_summary, read_job_deliveries, read_subscription_deliveries
+)
+from pruning import Sweeper
+from type_registry import TypeRegistry
+from audience import AudienceSnapshot, AUDIENCE_CACHE
+from segments import SegmentIndex, parse_target, format_target, target_type_keys, valid_type_key, iter_ids
+from changes import fetch_by_ids
+from transfer import (
+    read_export_start, export_lines, read_lines, parse_type, TYPE_UPSERT, IMPORT_BATCH, IMPORT_MAX_ERRORS
+)
+from migrations import migrate, drop_all
+from static_assets import AssetTable
+from metrics import registry, current_endpoint, DISPATCH_JOBS, DISPATCH_PENDING, CONTENT_TYPE
+
+
+async def track_endpoint(request: Request):
+    """Разметить запросы к БД именем эндпоинта (для sqlite_query_duration_seconds)"""
+    current_endpoint.set(request.scope["endpoint"].__name__)
+
+app = FastAPI(dependencies=[Depends(track_endpoint)])
 
 # CORS для локального тестирования и продакшена
 app.add_middleware(
@@ -32,97 +63,102 @@ VAPID_PRIVATE_KEY = os.getenv("VAPID_PRIVATE_KEY")
 VAPID_PUBLIC_KEY = os.getenv("VAPID_PUBLIC_KEY")
 VAPID_CLAIMS = {"sub": "mailto:test@example.com"}
 
-# База данных SQLite
-DB_PATH = "subscriptions.db"
+# Параллельная рассылка через общий пул соединений
+push_sender = PushSender(VAPID_PRIVATE_KEY, VAPID_CLAIMS)
 
-def get_db():
-    """Получить соединение с БД"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# База данных SQLite (пул соединений, запросы выполняются вне event loop).
+# Все воркеры uvicorn указывают на один и тот же файл на локальном диске:
+# WAL работает через общую память, поэтому несколько хостов (в т.ч. через
+# сетевую ФС) не поддерживаются
+DB_PATH = os.path.abspath(os.getenv("DB_PATH", "subscriptions.db"))
+db = Database(DB_PATH)
 
-def init_db():
-    """Инициализация базы данных"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    # Таблица для типов подписок
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS subscription_types (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            type_key TEXT UNIQUE NOT NULL,
-            type_name TEXT NOT NULL,
-            type_description TEXT,
-            type_color TEXT DEFAULT '#e2e3e5',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Добавляем начальные типы, если таблица пуста
-    c.execute("SELECT COUNT(*) as count FROM subscription_types")
-    if c.fetchone()['count'] == 0:
-        initial_types = [
-            ('general', 'Общие уведомления', 'Обычные уведомления для всех', '#e2e3e5'),
-            ('news', 'Новости', 'Новости и обновления', '#cce5ff'),
-            ('promo', 'Акции и скидки', 'Специальные предложения', '#d4edda'),
-            ('urgent', 'Срочные уведомления', 'Важные сообщения', '#f8d7da')
-        ]
-        c.executemany(
-            "INSERT INTO subscription_types (type_key, type_name, type_description, type_color) VALUES (?, ?, ?, ?)",
-            initial_types
-        )
-        print("✅ Добавлены начальные типы подписок")
-    
-    # Таблица для подписок пользователей
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            endpoint TEXT UNIQUE,
-            auth_key TEXT,
-            p256dh_key TEXT,
-            user_agent TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Проверяем, есть ли колонка subscription_type
-    c.execute("PRAGMA table_info(subscriptions)")
-    columns = [column[1] for column in c.fetchall()]
-    
-    if 'subscription_type' not in columns:
-        print("🔄 Добавляем колонку subscription_type в таблицу subscriptions...")
-        try:
-            c.execute("ALTER TABLE subscriptions ADD COLUMN subscription_type TEXT DEFAULT 'general'")
-            print("✅ Колонка subscription_type успешно добавлена")
-        except Exception as e:
-            print(f"⚠️ Ошибка при добавлении колонки: {e}")
-    
-    # Проверяем, есть ли внешний ключ (опционально)
-    if 'subscription_type' in columns:
-        # Обновляем существующие записи, у которых тип не указан
-        c.execute("UPDATE subscriptions SET subscription_type = 'general' WHERE subscription_type IS NULL")
-        print("🔄 Обновлены существующие подписки, установлен тип 'general'")
-    
-    conn.commit()
-    conn.close()
-    print("✅ База данных SQLite инициализирована")
+# Сохранение подписки одним запросом: новая вставляется, существующая обновляется
+SUBSCRIBE_UPSERT = """
+    INSERT INTO subscriptions (endpoint, auth_key, p256dh_key, user_agent, subscription_type, type_keys)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (endpoint) DO UPDATE SET
+        auth_key = excluded.auth_key,
+        p256dh_key = excluded.p256dh_key,
+        subscription_type = excluded.subscription_type,
+        type_keys = excluded.type_keys,
+        failure_count = 0
+"""
+subscription_writer = GroupCommitBuffer(db, SUBSCRIBE_UPSERT)
+SUBSCRIBE_BATCH_LIMIT = int(os.getenv("SUBSCRIBE_BATCH_LIMIT", "10000"))
+# Наибольший размер страницы /api/debug/subscriptions и журнала доставки
+DEBUG_PAGE_LIMIT = int(os.getenv("DEBUG_PAGE_LIMIT", "1000"))
+# Насколько далеко вперед можно запланировать рассылку
+SCHEDULE_MAX_AHEAD_DAYS = int(os.getenv("SCHEDULE_MAX_AHEAD_DAYS", "365"))
 
+# Файлы фронтенда, загруженные в память при старте
+FRONTEND_DIR = Path(__file__).resolve().parent.parent / "frontend"
+frontend_assets = AssetTable(FRONTEND_DIR)
+
+# Типы подписок в памяти процесса
+type_registry = TypeRegistry(db)
+
+# Битовые карты подписчиков по типам для выражений таргетинга и статистики
+segments = SegmentIndex(db)
+
+# Снимок подписчиков в памяти для рассылок (AUDIENCE_CACHE=1)
+audience = AudienceSnapshot(db) if AUDIENCE_CACHE else None
+
+# Журнал доставки по подписчикам с отложенной записью (DELIVERY_LOG=0 - выключен)
+delivery_log = DeliveryLog(db) if DELIVERY_LOG else None
+
+# Фоновые воркеры рассылки
+dispatcher = Dispatcher(db, push_sender, segments, audience=audience, deliveries=delivery_log)
+
+# Отложенные рассылки (send_at)
+scheduler = Scheduler(db, dispatcher)
+
+# Метрики, которые считаются в момент запроса /metrics
+registry.gauge(
+    "push_queue_depth", "Зашифрованные сообщения в очереди на отправку",
+    fn=lambda: push_sender.queue_stats()["queued"]
+)
+registry.gauge(
+    "push_retry_pending", "Сообщения, ожидающие повтора",
+    fn=lambda: push_sender.queue_stats()["retry_pending"]
+)
+registry.gauge(
+    "push_service_limit", "Адаптивный лимит одновременных запросов к push-сервису", ("service",),
+    fn=lambda: {(service,): limiter.limit for service, limiter in push_sender.limiters.items()}
+)
+registry.gauge(
+    "push_service_in_flight", "Запросы к push-сервису, выполняющиеся сейчас", ("service",),
+    fn=lambda: {(service,): limiter.in_flight for service, limiter in push_sender.limiters.items()}
+)
+registry.gauge(
+    "subscribe_write_queue_depth", "Подписки, ожидающие группового commit",
+    fn=lambda: subscription_writer.queued
+)
+if delivery_log is not None:
+    registry.gauge(
+        "delivery_log_buffered", "Строки журнала доставки, ожидающие записи",
+        fn=lambda: delivery_log.buffered
+    )
+if audience is not None:
+    registry.gauge(
+        "audience_subscribers", "Подписчики в снимке аудитории процесса",
+        fn=lambda: len(audience)
+    )
+
+# Периодическая очистка подписок, которые перестали доставляться
+sweeper = Sweeper(db)
 
 @app.post("/api/debug/reset-db")
 async def reset_db():
     """Полностью пересоздать таблицы (только для отладки!)"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Удаляем существующие таблицы
-        c.execute("DROP TABLE IF EXISTS subscriptions")
-        c.execute("DROP TABLE IF EXISTS subscription_types")
-        conn.commit()
-        conn.close()
-        
-        # Переинициализируем БД
-        init_db()
+        # Удаляем существующие таблицы и заново применяем миграции
+        await db.run(drop_all)
+        await db.run(migrate)
+        await type_registry.reload()
+        await segments.reload()
+        if audience is not None:
+            await audience.reload()
         
         return JSONResponse({"status": "database reset successfully"})
     except Exception as e:
@@ -131,24 +167,46 @@ async def reset_db():
 
 @app.on_event("startup")
 async def startup():
-    init_db()
+    # Миграции выполняет один процесс под блокировкой; актуальная схема не проверяется заново
+    await db.run(migrate)
+    await type_registry.start()
+    logger.info("Загружены файлы фронтенда", extra={"fields": {"files": frontend_assets.load()}})
+    await push_sender.start()
+    await segments.start()
+    if audience is not None:
+        await audience.start()
+    if delivery_log is not None:
+        await delivery_log.start()
+    await dispatcher.start()
+    await scheduler.start()
+    await sweeper.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await sweeper.stop()
+    await scheduler.stop()
+    await dispatcher.stop()
+    if delivery_log is not None:
+        await delivery_log.stop()
+    if audience is not None:
+        await audience.stop()
+    await segments.stop()
+    await type_registry.stop()
+    await push_sender.close()
+    db.close()
 
 # ========== Эндпоинты для управления типами подписок ==========
 
 @app.get("/api/types")
-async def get_subscription_types():
-    """Получить все типы подписок"""
-    try:
-        conn = get_db()
-        c = conn.cursor()
-        types = c.execute("SELECT type_key, type_name, type_description, type_color FROM subscription_types ORDER BY id").fetchall()
-        conn.close()
-        
-        return JSONResponse({
-            "types": [dict(t) for t in types]
-        })
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+async def get_subscription_types(request: Request):
+    """Получить все типы подписок (из кэша, с поддержкой If-None-Match)"""
+    headers = {"ETag": type_registry.etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == type_registry.etag:
+        return Response(status_code=304, headers=headers)
+    
+    return JSONResponse({
+        "types": type_registry.types
+    }, headers=headers)
 
 @app.post("/api/types")
 async def create_subscription_type(request: Request):
@@ -162,17 +220,18 @@ async def create_subscription_type(request: Request):
         
         if not type_key or not type_name:
             raise HTTPException(status_code=400, detail="type_key и type_name обязательны")
+        if not valid_type_key(type_key):
+            raise HTTPException(status_code=400, detail="type_key: буквы, цифры, _ . -; all, and, or, not заняты")
         
-        conn = get_db()
-        c = conn.cursor()
-        c.execute(
+        await db.execute(
             "INSERT INTO subscription_types (type_key, type_name, type_description, type_color) VALUES (?, ?, ?, ?)",
             (type_key, type_name, type_description, type_color)
         )
-        conn.commit()
-        conn.close()
+        await type_registry.reload()
         
         return JSONResponse({"status": "ok", "type_key": type_key})
+    except HTTPException:
+        raise
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Тип с таким ключом уже существует")
     except Exception as e:
@@ -187,9 +246,6 @@ async def update_subscription_type(type_key: str, request: Request):
         type_description = data.get("type_description")
         type_color = data.get("type_color")
         
-        conn = get_db()
-        c = conn.cursor()
-        
         updates = []
         values = []
         if type_name:
@@ -204,13 +260,12 @@ async def update_subscription_type(type_key: str, request: Request):
         
         if updates:
             values.append(type_key)
-            c.execute(
+            await db.execute(
                 f"UPDATE subscription_types SET {', '.join(updates)} WHERE type_key = ?",
                 values
             )
-            conn.commit()
+            await type_registry.reload()
         
-        conn.close()
         return JSONResponse({"status": "ok"})
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -219,55 +274,56 @@ async def update_subscription_type(type_key: str, request: Request):
 async def delete_subscription_type(type_key: str):
     """Удалить тип подписки"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Проверяем, есть ли подписки этого типа
-        c.execute("SELECT COUNT(*) as count FROM subscriptions WHERE subscription_type = ?", (type_key,))
-        if c.fetchone()['count'] > 0:
-            conn.close()
+        def delete_type(conn):
+            with conn:
+                # Проверка подписчиков и удаление - одним запросом, чтобы между
+                # ними не успела сохраниться подписка этого типа
+                c = conn.execute("""
+                    DELETE FROM subscription_types WHERE type_key = ?
+                      AND NOT EXISTS (SELECT 1 FROM subscription_type_members WHERE type_key = ?)
+                """, (type_key, type_key))
+                if c.rowcount:
+                    return True
+                return conn.execute("SELECT 1 FROM subscription_types WHERE type_key = ?", (type_key,)).fetchone() is None
+        
+        if not await db.run(delete_type):
             raise HTTPException(status_code=400, detail="Нельзя удалить тип, у которого есть подписчики")
-        
-        c.execute("DELETE FROM subscription_types WHERE type_key = ?", (type_key,))
-        conn.commit()
-        conn.close()
+        await type_registry.reload()
         
         return JSONResponse({"status": "ok"})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/api/types/stats")
 async def get_subscription_stats():
-    """Получить статистику по типам подписок"""
+    """Получить статистику по типам подписок и их попарным пересечениям"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Общая статистика
-        types = c.execute("""
-            SELECT 
-                st.type_key,
-                st.type_name,
-                st.type_color,
-                COUNT(s.id) as subscriber_count
-            FROM subscription_types st
-            LEFT JOIN subscriptions s ON st.type_key = s.subscription_type
-            GROUP BY st.type_key, st.type_name, st.type_color
-            ORDER BY st.id
-        """).fetchall()
-        
-        # Общее количество подписок
-        total = c.execute("SELECT COUNT(*) as count FROM subscriptions").fetchone()['count']
-        
-        conn.close()
+        # Битовые карты в памяти; догоняем журнал изменений одним коротким запросом
+        await segments.sync()
+        stats = segments.stats()
+        types = [{
+            "type_key": t["type_key"],
+            "type_name": t["type_name"],
+            "type_color": t["type_color"],
+            "subscriber_count": stats["types"].get(t["type_key"], 0)
+        } for t in type_registry.types]
         
         return JSONResponse({
-            "total": total,
-            "types": [dict(t) for t in types]
+            "total": stats["total"],
+            "types": types,
+            "overlaps": stats["overlaps"]
         })
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/api/types/stats/reconcile")
+async def reconcile_subscription_stats():
+    """Перестроить битовые карты подписчиков по типам из БД с нуля"""
+    await segments.reload()
+    return JSONResponse({"status": "ok", "counts": segments.stats()["types"]})
+
 # ========== Основные эндпоинты для PWA ==========
 
 @app.get("/api/vapid-public-key")
@@ -275,77 +331,235 @@ async def get_vapid_public_key():
     """Отдаем публичный ключ клиенту"""
     return JSONResponse({"publicKey": VAPID_PUBLIC_KEY})
 
+def parse_subscription(subscription, user_agent):
+    """Проверить подписку и подготовить строку для SUBSCRIBE_UPSERT"""
+    if not isinstance(subscription, dict):
+        raise ValueError("subscription must be an object")
+    
+    endpoint = subscription.get("endpoint")
+    keys = subscription.get("keys") or {}
+    # Несколько типов ("types") или один ("type"); первый - основной
+    requested_types = subscription.get("types") or [subscription.get("type", "general")]
+    
+    if not endpoint:
+        raise ValueError("endpoint is required")
+    
+    if not isinstance(endpoint, str):
+        raise ValueError("endpoint must be a string")
+    
+    if not isinstance(keys, dict):
+        raise ValueError("keys must be an object")
+    
+    if not keys.get("auth") or not keys.get("p256dh"):
+        raise ValueError("auth and p256dh keys are required")
+    
+    if not isinstance(keys["auth"], str) or not isinstance(keys["p256dh"], str):
+        raise ValueError("auth and p256dh keys must be strings")
+    
+    if user_agent is not None and not isinstance(user_agent, str):
+        raise ValueError("user_agent must be a string")
+    
+    if not isinstance(requested_types, list):
+        raise ValueError("types must be a list")
+    
+    type_keys = list(dict.fromkeys(
+        t for t in requested_types if isinstance(t, str) and type_registry.exists(t)
+    ))
+    if not type_keys:
+        type_keys = ["general"]  # fallback на general
+    
+    return (endpoint, keys["auth"], keys["p256dh"], user_agent, type_keys[0], json.dumps(type_keys))
+
 @app.post("/api/subscribe")
 async def subscribe(request: Request):
     """Сохранение подписки от браузера с типом"""
     try:
-        # Получаем данные запроса
-        body = await request.body()
-        print(f"📥 Получен запрос на подписку, тело: {body[:200]}...")
-        
         subscription = await request.json()
-        print(f"📦 Данные подписки: {json.dumps(subscription, indent=2)[:500]}")
-        
-        endpoint = subscription.get("endpoint")
-        keys = subscription.get("keys", {})
-        subscription_type = subscription.get("type", "general")
-        
-        if not endpoint:
-            raise HTTPException(status_code=400, detail="endpoint is required")
-        
-        if not keys.get("auth") or not keys.get("p256dh"):
-            raise HTTPException(status_code=400, detail="auth and p256dh keys are required")
-        
-        conn = get_db()
-        c = conn.cursor()
         
-        # Проверяем, существует ли такой тип
-        c.execute("SELECT type_key FROM subscription_types WHERE type_key = ?", (subscription_type,))
-        type_exists = c.fetchone()
-        if not type_exists:
-            print(f"⚠️ Тип {subscription_type} не найден, используем 'general'")
-            subscription_type = "general"  # fallback на general
-        
-        # Проверяем, существует ли уже такая подписка
-        c.execute("SELECT id FROM subscriptions WHERE endpoint = ?", (endpoint,))
-        existing = c.fetchone()
-        
-        if existing:
-            # Обновляем существующую
-            c.execute(
-                "UPDATE subscriptions SET auth_key = ?, p256dh_key = ?, subscription_type = ? WHERE endpoint = ?",
-                (keys.get("auth"), keys.get("p256dh"), subscription_type, endpoint)
-            )
-            print(f"🔄 Обновлена подписка (тип: {subscription_type}): {endpoint[:50]}...")
-        else:
-            # Создаем новую
-            c.execute(
-                """INSERT INTO subscriptions 
-                   (endpoint, auth_key, p256dh_key, user_agent, subscription_type) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                (endpoint, keys.get("auth"), keys.get("p256dh"), 
-                 request.headers.get('User-Agent', ''), subscription_type)
-            )
-            print(f"✅ Новая подписка (тип: {subscription_type}): {endpoint[:50]}...")
+        try:
+            row = parse_subscription(subscription, request.headers.get('User-Agent', ''))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        endpoint, subscription_type, type_keys = row[0], row[4], json.loads(row[5])
+        requested_types = subscription.get("types") or [subscription.get("type", "general")]
+        if type_keys != requested_types:
+            log_subscriber(logger, logging.WARNING, "Часть типов не найдена",
+                           requested_types=requested_types, types=type_keys)
+        
+        # Одиночные подписки объединяются в общую транзакцию с соседними
+        await subscription_writer.submit(row)
+        log_subscriber(logger, logging.DEBUG, "Подписка сохранена",
+                       types=type_keys, endpoint=endpoint[:50])
+        
+        return JSONResponse({"status": "ok", "type": subscription_type, "types": type_keys})
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning("Ошибка сохранения подписки", extra={"fields": {"error": str(e)}})
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/api/subscribe/batch")
+async def subscribe_batch(request: Request):
+    """Массовый импорт подписок одной транзакцией"""
+    try:
+        data = await request.json()
+        items = data.get("subscriptions") if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="subscriptions list is required")
+        if len(items) > SUBSCRIBE_BATCH_LIMIT:
+            raise HTTPException(status_code=400, detail=f"не больше {SUBSCRIBE_BATCH_LIMIT} подписок за запрос")
+        
+        user_agent = request.headers.get('User-Agent', '')
+        rows = []
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                item_user_agent = item.get("user_agent") if isinstance(item, dict) else None
+                rows.append(parse_subscription(item, item_user_agent or user_agent))
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
         
-        conn.commit()
-        conn.close()
+        if rows:
+            await db.executemany(SUBSCRIBE_UPSERT, rows)
+        logger.info("Импорт подписок", extra={"fields": {"imported": len(rows), "skipped": len(errors)}})
         
-        return JSONResponse({"status": "ok", "type": subscription_type})
+        return JSONResponse({
+            "status": "ok",
+            "imported": len(rows),
+            "skipped": len(errors),
+            "errors": errors
+        })
     except HTTPException:
         raise
     except Exception as e:
-        print(f"❌ Ошибка сохранения: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.warning("Ошибка импорта подписок", extra={"fields": {"error": str(e)}})
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/api/subscriptions/export")
+async def export_subscriptions(since_seq: int = None):
+    """Потоковая выгрузка типов и подписок в NDJSON (см. transfer.py).
+    since_seq - только подписки, изменённые после этой позиции журнала"""
+    try:
+        seq, types = await db.run(read_export_start, since_seq)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    logger.info("Выгрузка подписок", extra={"fields": {"seq": seq, "since_seq": since_seq}})
+    return StreamingResponse(
+        export_lines(db, seq, types, since_seq),
+        media_type="application/x-ndjson",
+        headers={"X-Export-Seq": str(seq)}
+    )
+
+@app.post("/api/subscriptions/import")
+async def import_subscriptions(request: Request):
+    """Потоковая загрузка NDJSON из /api/subscriptions/export.
+    Подписки записываются пачками по IMPORT_BATCH, типы - сразу"""
+    user_agent = request.headers.get('User-Agent', '')
+    result = {"types": 0, "imported": 0, "skipped": 0, "source_seq": None, "complete": False, "errors": []}
+    rows = []
+    
+    async def flush():
+        if rows:
+            await db.executemany(SUBSCRIBE_UPSERT, rows)
+            result["imported"] += len(rows)
+            rows.clear()
+    
+    error = None
+    try:
+        async for line_no, line in read_lines(request.stream()):
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("строка должна быть объектом")
+                kind = record.get("kind", "subscription")
+                if kind == "subscription":
+                    rows.append(parse_subscription(record, record.get("user_agent") or user_agent))
+                elif kind == "type":
+                    await db.execute(TYPE_UPSERT, parse_type(record))
+                    # Следующие подписки проверяются уже с этим типом
+                    await type_registry.reload()
+                    result["types"] += 1
+                elif kind == "header":
+                    result["source_seq"] = record.get("seq")
+                elif kind == "end":
+                    result["complete"] = True
+                else:
+                    raise ValueError(f"неизвестный kind: {kind!r}")
+            except ValueError as e:
+                result["skipped"] += 1
+                if len(result["errors"]) < IMPORT_MAX_ERRORS:
+                    result["errors"].append({"line": line_no, "error": str(e)})
+            if len(rows) >= IMPORT_BATCH:
+                await flush()
+    except ValueError as e:
+        error = e
+    finally:
+        # Уже проверенные строки записываются при любом исходе
+        await flush()
+    if error is not None:
+        raise HTTPException(status_code=400, detail=f"{error}; загружено подписок: {result['imported']}")
+    
+    logger.info("Загрузка подписок", extra={"fields": {
+        key: result[key] for key in ("types", "imported", "skipped", "source_seq", "complete")
+    }})
+    return JSONResponse({"status": "ok", **result})
+
+def parse_send_options(data):
+    """Время отправки (unix-время или None - сразу) и параметры Web Push
+    (ttl, topic, urgency) из запроса рассылки"""
+    send_at = data.get("send_at")
+    if send_at is not None:
+        if isinstance(send_at, (int, float)) and not isinstance(send_at, bool):
+            send_at = float(send_at)
+        elif isinstance(send_at, str):
+            try:
+                moment = datetime.fromisoformat(send_at.replace("Z", "+00:00"))
+            except ValueError:
+                raise ValueError("send_at: unix-время или дата ISO 8601")
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            send_at = moment.timestamp()
+        else:
+            raise ValueError("send_at: unix-время или дата ISO 8601")
+        # Проверка до записи задачи: NaN, inf и даты вне диапазона datetime
+        try:
+            datetime.fromtimestamp(send_at, timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise ValueError("send_at: недопустимое время")
+        if send_at > time.time() + SCHEDULE_MAX_AHEAD_DAYS * 86400:
+            raise ValueError(f"send_at: не дальше {SCHEDULE_MAX_AHEAD_DAYS} дней вперед")
+        if send_at <= time.time():
+            send_at = None
+    
+    options = {key: data.get(key) for key in ("ttl", "topic", "urgency") if data.get(key) is not None}
+    push_headers(**options)  # проверка значений
+    return send_at, options
+
 @app.post("/api/send-notification")
 async def send_notification(request: Request):
-    """Отправка уведомления с фильтром по типу подписки"""
+    """Постановка рассылки в очередь.
+
+    targetType - тип подписки, all или выражение над типами,
+    например "(news | promo) & !urgent" (синтаксис - в segments.py).
+    send_at - время отправки (unix-время или ISO 8601), ttl, topic, urgency -
+    заголовки Web Push. Новая рассылка с topic заменяет незавершенные
+    рассылки той же аудитории и темы.
+    """
     try:
         data = await request.json()
-        target_type = data.get("targetType", "all")
+        try:
+            target = parse_target(data.get("targetType", "all"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"targetType: {e}")
+        unknown = sorted(key for key in target_type_keys(target) if not type_registry.exists(key))
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Неизвестные типы: {', '.join(unknown)}")
+        target_type = format_target(target)
+        try:
+            send_at, options = parse_send_options(data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         message_title = data.get("title", "Уведомление")
         message_body = data.get("body", "")
         
@@ -354,153 +568,209 @@ async def send_notification(request: Request):
             "body": message_body,
             "icon": "/icons/icon-192.png",
             "badge": "/icons/badge.png",
-            "data": {"url": data.get("url", "/")}
+            "data": {"url": data.get("url", "/")},
+            # Браузер заменяет показанное уведомление с той же темой
+            **({"tag": options["topic"]} if "topic" in options else {})
         })
-        
-        conn = get_db()
-        c = conn.cursor()
-        
-        # Формируем запрос в зависимости от целевой аудитории
-        if target_type == "all":
-            subscriptions = c.execute(
-                "SELECT id, endpoint, auth_key, p256dh_key, subscription_type FROM subscriptions"
-            ).fetchall()
-            print(f"📊 Отправка ВСЕМ подписчикам")
-        else:
-            subscriptions = c.execute(
-                "SELECT id, endpoint, auth_key, p256dh_key, subscription_type FROM subscriptions WHERE subscription_type = ?",
-                (target_type,)
-            ).fetchall()
-            
-            # Получаем название типа для вывода
-            type_info = c.execute("SELECT type_name FROM subscription_types WHERE type_key = ?", (target_type,)).fetchone()
-            type_name = type_info['type_name'] if type_info else target_type
-            print(f"📊 Отправка подписчикам типа: {type_name}")
-        
-        conn.close()
-        
-        print(f"\n{'='*60}")
-        print(f"📨 Сообщение: {message_title} - {message_body}")
-        print(f"📊 Найдено подписок: {len(subscriptions)}")
-        
-        success_count = 0
-        error_count = 0
-        deleted_count = 0
-        
-        for sub in subscriptions:
-            # Определяем тип браузера/сервиса по endpoint
-            try:
-                service = sub['endpoint'].split('/')[2]
-            except:
-                service = "unknown"
-            
-            print(f"\n📌 Подписка #{sub['id']} (тип: {sub['subscription_type']}) - сервис: {service}")
-            
-            subscription_info = {
-                "endpoint": sub['endpoint'],
-                "keys": {
-                    "auth": sub['auth_key'],
-                    "p256dh": sub['p256dh_key']
-                }
-            }
-            
-            try:
-                parsed_url = urlparse(sub['endpoint'])
-                origin = f"{parsed_url.scheme}://{parsed_url.netloc}"
-                
-                dynamic_claims = VAPID_CLAIMS.copy()
-                dynamic_claims["aud"] = origin
-                
-                webpush(
-                    subscription_info=subscription_info,
-                    data=payload,
-                    vapid_private_key=VAPID_PRIVATE_KEY,
-                    vapid_claims=dynamic_claims
-                )
-                success_count += 1
-                print(f"   ✅ Успешно отправлено")
-                
-            except WebPushException as ex:
-                error_count += 1
-                print(f"   ❌ Ошибка: {ex}")
-                
-                if ex.response:
-                    print(f"      Статус: {ex.response.status_code}")
-                    
-                    if ex.response.status_code in [410, 404]:
-                        conn = get_db()
-                        c = conn.cursor()
-                        c.execute("DELETE FROM subscriptions WHERE id = ?", (sub['id'],))
-                        conn.commit()
-                        conn.close()
-                        deleted_count += 1
-                        print(f"      🗑️ Подписка удалена из БД")
-                    elif ex.response.status_code == 403:
-                        print(f"      ⚠️ Ошибка 403 Forbidden - подписка сохранена")
-                
-            except Exception as e:
-                error_count += 1
-                print(f"   ❌ Неизвестная ошибка: {e}")
-        
-        print(f"\n{'='*60}")
-        print(f"📊 ИТОГИ ОТПРАВКИ:")
-        print(f"   ✅ Успешно: {success_count}")
-        print(f"   ❌ Ошибок: {error_count}")
-        print(f"   🗑️ Удалено: {deleted_count}")
+        target_name = type_registry.get_name(target_type) if target[0] == "type" else target_type
+        
+        if send_at is not None:
+            job_id, superseded = await scheduler.schedule(target_type, payload, send_at, **options)
+            logger.info("Рассылка запланирована", extra={"fields": {
+                "job_id": job_id,
+                "target": target_name,
+                "title": message_title,
+                "send_at": send_at,
+                "superseded": superseded
+            }})
+            return JSONResponse({
+                "status": "scheduled",
+                "job_id": job_id,
+                "send_at": datetime.fromtimestamp(send_at, timezone.utc).isoformat(),
+                "superseded": superseded
+            })
+        
+        job_id, total, superseded = await dispatcher.enqueue(target_type, payload, **options)
+        
+        logger.info("Рассылка поставлена в очередь", extra={"fields": {
+            "job_id": job_id,
+            "target": target_name,
+            "title": message_title,
+            "total": total,
+            "superseded": superseded
+        }})
         
         return JSONResponse({
-            "status": "ok",
-            "sent": success_count,
-            "failed": error_count,
-            "deleted": deleted_count,
-            "total_original": len(subscriptions)
+            "status": "queued",
+            "job_id": job_id,
+            "total_original": total,
+            "superseded": superseded
         })
         
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"❌ Критическая ошибка: {e}")
+        logger.exception("Ошибка постановки рассылки в очередь")
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: int):
+    """Прогресс фоновой рассылки"""
+    job = await dispatcher.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    return JSONResponse(job)
+
+@app.get("/api/jobs/{job_id}/deliveries")
+async def get_job_deliveries(job_id: int, after: int = 0, limit: int = 100, status: str = None):
+    """Итоги рассылки по результатам и HTTP-статусам и журнал доставки по
+    подписчикам страницами (следующая - after=next_after)"""
+    if not 1 <= limit <= DEBUG_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit: от 1 до {DEBUG_PAGE_LIMIT}")
+    if not await dispatcher.get_job(job_id):
+        raise HTTPException(status_code=404, detail="Рассылка не найдена")
+    if delivery_log is not None:
+        await delivery_log.flush()
+    summary = await db.run(read_job_summary, job_id)
+    deliveries = await db.run(read_job_deliveries, job_id, after, limit, status)
+    return JSONResponse({
+        "job_id": job_id,
+        **summary,
+        "limit": limit,
+        "next_after": deliveries[-1]["id"] if len(deliveries) == limit else None,
+        "deliveries": deliveries
+    })
+
+@app.get("/api/subscriptions/{subscription_id}/deliveries")
+async def get_subscription_deliveries(subscription_id: int, before: int = None, limit: int = 100):
+    """История доставки подписчику от новых к старым (следующая страница -
+    before=next_before). Хранится DELIVERY_RETENTION_DAYS дней"""
+    if not 1 <= limit <= DEBUG_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit: от 1 до {DEBUG_PAGE_LIMIT}")
+    if delivery_log is not None:
+        await delivery_log.flush()
+    deliveries = await db.run(read_subscription_deliveries, subscription_id, before, limit)
+    return JSONResponse({
+        "subscription_id": subscription_id,
+        "limit": limit,
+        "next_before": deliveries[-1]["id"] if len(deliveries) == limit else None,
+        "deliveries": deliveries
+    })
+
 # ========== Отладочные эндпоинты ==========
 
+DEBUG_SUBSCRIPTIONS_QUERY = """
+    SELECT s.*, t.type_name, t.type_color
+    FROM subscriptions s
+    LEFT JOIN subscription_types t ON s.subscription_type = t.type_key
+"""
+
 @app.get("/api/debug/subscriptions")
-async def debug_subscriptions():
-    """Просмотр всех подписок"""
+async def debug_subscriptions(after: int = 0, limit: int = 100, target: str = None):
+    """Просмотр подписок страницами по id: следующая страница - after=next_after.
+    target - выражение таргетинга (news, news | promo, ...)"""
+    if not 1 <= limit <= DEBUG_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit: от 1 до {DEBUG_PAGE_LIMIT}")
     try:
-        conn = get_db()
-        c = conn.cursor()
-        
-        subscriptions = c.execute("""
-            SELECT s.*, t.type_name, t.type_color 
-            FROM subscriptions s
-            LEFT JOIN subscription_types t ON s.subscription_type = t.type_key
-        """).fetchall()
-        
-        conn.close()
+        await segments.sync()
+        if target is None:
+            total = len(segments)
+            subscriptions = await db.fetchall(
+                DEBUG_SUBSCRIPTIONS_QUERY + " WHERE s.id > ? ORDER BY s.id LIMIT ?", (after, limit)
+            )
+        else:
+            try:
+                bitmap = segments.evaluate(parse_target(target))
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"target: {e}")
+            total = bitmap.bit_count()
+            # id следующей страницы берутся из битовой карты, строки - по первичному ключу
+            ids = list(islice(iter_ids(bitmap, after), limit))
+            subscriptions = await db.run(
+                fetch_by_ids, DEBUG_SUBSCRIPTIONS_QUERY + " WHERE s.id IN ({ids}) ORDER BY s.id", ids
+            )
         
         return JSONResponse({
-            "total": len(subscriptions),
+            "total": total,
+            "limit": limit,
+            "next_after": subscriptions[-1]["id"] if len(subscriptions) == limit else None,
             "subscriptions": [dict(s) for s in subscriptions]
         })
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse({"error": str(e)}, status_code=500)
 
+@app.get("/api/debug/vapid-cache")
+async def debug_vapid_cache():
+    """Статистика кэша VAPID-подписей"""
+    if push_sender.vapid_cache is None:
+        return JSONResponse({"error": "VAPID_PRIVATE_KEY не задан"}, status_code=500)
+    return JSONResponse(push_sender.vapid_cache.stats())
+
+@app.get("/api/debug/push-services")
+async def debug_push_services():
+    """Адаптивные лимиты и блокировки Retry-After по push-сервисам"""
+    return JSONResponse(push_sender.limiter_stats())
+
+@app.get("/api/debug/audience")
+async def debug_audience():
+    """Размер снимка аудитории в памяти процесса"""
+    if audience is None:
+        return JSONResponse({"enabled": False})
+    return JSONResponse({"enabled": True, **audience.stats()})
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в текстовом формате Prometheus"""
+    job_stats = await dispatcher.job_stats()
+    DISPATCH_JOBS.replace({(status,): jobs for status, (jobs, _) in job_stats.items()})
+    DISPATCH_PENDING.replace({(status,): pending for status, (_, pending) in job_stats.items()})
+    return Response(registry.render(), headers={"Content-Type": CONTENT_TYPE})
+
+@app.post("/api/debug/sweep")
+async def debug_sweep():
+    """Немедленная очистка подписок, которые перестали доставляться"""
+    deleted = await sweeper.sweep()
+    return JSONResponse({"status": "ok", "deleted": deleted})
+
 @app.post("/api/debug/clear-all")
 async def clear_all():
     """Очистка всех подписок"""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM subscriptions")
-    conn.commit()
-    conn.close()
+    await db.execute("DELETE FROM subscriptions")
     return JSONResponse({"status": "all subscriptions deleted"})
 
 @app.get("/")
 @app.get("/{full_path:path}")
-async def serve_frontend(full_path: str = ""):
-    frontend_path = Path("../frontend") / full_path
-    if frontend_path.exists() and frontend_path.is_file():
-        return FileResponse(frontend_path)
-    return FileResponse("../frontend/index.html")
+async def serve_frontend(request: Request, full_path: str = ""):
+    """Статика фронтенда из памяти: сжатие, ETag и условные запросы"""
+    asset = frontend_assets.lookup(full_path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    encoding = asset.choose(request.headers.get("Accept-Encoding", ""))
+    body, etag = asset.variants[encoding]
+    headers = {
+        "ETag": etag,
+        "Cache-Control": asset.cache_control,
+        "Vary": "Accept-Encoding"
+    }
+    
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        client_etags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in client_etags or "*" in client_etags:
+            return Response(status_code=304, headers=headers)
+    
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    headers["Content-Type"] = asset.content_type
+    return Response(body, headers=headers)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
+    # Несколько воркеров делят одну БД: схему мигрирует первый, рассылки идут частями
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        uvicorn.run("server:app", host="0.0.0.0", port=5000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
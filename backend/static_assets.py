@@ -0,0 +1,89 @@
+import re
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен, без него отдаем только gzip
+    brotli = None
+
+# Файлы с хэшем содержимого в имени (app.3f9a1c2b.js) кэшируются навсегда
+FINGERPRINT_RE = re.compile(r"\.[0-9a-f]{8,}\.[A-Za-z0-9]+$")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# Остальные файлы (в т.ч. service-worker.js и manifest.json) всегда перепроверяются по ETag
+REVALIDATE_CACHE = "no-cache"
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json",
+                      "application/manifest+json", "image/svg+xml")
+MIN_COMPRESS_SIZE = 256
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class Asset:
+    """Файл фронтенда в памяти вместе со сжатыми вариантами"""
+
+    __slots__ = ("content_type", "cache_control", "variants")
+
+    def __init__(self, path, data):
+        content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        if path.name == "manifest.json":
+            content_type = "application/manifest+json"
+        if content_type.startswith("text/") or content_type.endswith(("javascript", "json")):
+            content_type += "; charset=utf-8"
+        self.content_type = content_type
+        self.cache_control = IMMUTABLE_CACHE if FINGERPRINT_RE.search(path.name) else REVALIDATE_CACHE
+
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        # Кодировка -> (тело, ETag); у каждого варианта свой сильный ETag
+        self.variants = {"identity": (data, f'"{etag}"')}
+        if len(data) >= MIN_COMPRESS_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(gzipped) < len(data):
+                self.variants["gzip"] = (gzipped, f'"{etag}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data):
+                    self.variants["br"] = (compressed, f'"{etag}-br"')
+
+    def choose(self, accept_encoding):
+        """Выбрать вариант по Accept-Encoding: br, затем gzip, затем без сжатия"""
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.partition(";")
+            quality = params.strip()
+            if quality.startswith("q="):
+                try:
+                    if float(quality[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            accepted.add(name.strip())
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.variants:
+                return encoding
+        return "identity"
+
+
+class AssetTable:
+    """Все файлы фронтенда, загруженные в память при старте"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.assets = {}
+
+    def load(self):
+        assets = {}
+        if self.root.is_dir():
+            for path in self.root.rglob("*"):
+                if path.is_file():
+                    assets[path.relative_to(self.root).as_posix()] = Asset(path, path.read_bytes())
+        self.assets = assets
+        return len(assets)
+
+    def lookup(self, full_path):
+        """Файл по пути запроса; для неизвестных путей - index.html (SPA)"""
+        return self.assets.get(full_path) or self.assets.get("index.html")
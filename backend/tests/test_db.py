@@ -0,0 +1,56 @@
+import time
+import asyncio
+import sqlite3
+
+import pytest
+
+import db as db_module
+from db import Database, GroupCommitBuffer
+
+UPSERT = "INSERT INTO items (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_module, "DB_BUSY_TIMEOUT", 100)
+    path = str(tmp_path / "buffer.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE items (key TEXT PRIMARY KEY, value INTEGER NOT NULL CHECK (value >= 0))")
+    conn.close()
+    db = Database(path)
+    yield db
+    db.close()
+
+
+def submit_all(buffer, rows):
+    async def scenario():
+        return await asyncio.gather(*(buffer.submit(row) for row in rows), return_exceptions=True)
+
+    return asyncio.run(scenario())
+
+
+def test_group_commit_isolates_bad_rows(db):
+    buffer = GroupCommitBuffer(db, UPSERT, window=0.01)
+    results = submit_all(buffer, [("a", 1), ("b", -1), ("c", 3)])
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], sqlite3.IntegrityError)
+    rows = db.run_sync(lambda conn: conn.execute("SELECT key, value FROM items ORDER BY key").fetchall())
+    assert [tuple(row) for row in rows] == [("a", 1), ("c", 3)]
+
+
+def test_group_commit_fails_whole_chunk_when_locked(db, tmp_path):
+    # Соединение пула открыто заранее: блокировка мешает только записи
+    db.run_sync(lambda conn: conn.execute("SELECT 1"))
+    blocker = sqlite3.connect(str(tmp_path / "buffer.db"))
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        buffer = GroupCommitBuffer(db, UPSERT, window=0.01)
+        started = time.monotonic()
+        results = submit_all(buffer, [(f"k{n}", n) for n in range(20)])
+        elapsed = time.monotonic() - started
+    finally:
+        blocker.rollback()
+        blocker.close()
+    assert all(isinstance(result, sqlite3.OperationalError) for result in results)
+    # Одно ожидание busy_timeout на пачку, а не на каждую строку
+    assert elapsed < 1.0
@@ -0,0 +1,312 @@
+import time
+import asyncio
+import sqlite3
+
+import pytest
+
+import jobs
+from db import Database
+from jobs import Dispatcher, LeaseLost
+from migrations import migrate
+from push_sender import BatchResult
+from segments import SegmentIndex
+
+
+def create_db(path, subscribers):
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.executemany(
+        "INSERT INTO subscriptions (endpoint, auth_key, p256dh_key, subscription_type) VALUES (?, 'a', 'p', 'news')",
+        [(f"https://push.example/{n}",) for n in range(subscribers)]
+    )
+    conn.commit()
+    conn.close()
+
+
+def make_dispatcher(db, push_sender=None, **options):
+    return Dispatcher(db, push_sender, SegmentIndex(db, sync_interval=0), workers=0, **options)
+
+
+class FakeSender:
+    """Отправляет все пачки, но завершает их в порядке order (индексы
+    пачек); на пачке fail_at падает после отправки, до записи итогов"""
+
+    vapid_cache = object()
+
+    def __init__(self, order=None, fail_at=None):
+        self.order = order
+        self.fail_at = fail_at
+        self.sent = []
+
+    async def broadcast(self, batches, payload, on_batch_done=None, headers=None):
+        results = [BatchResult(subscriptions) async for subscriptions in batches]
+        totals = {"sent": 0, "failed": 0, "expired": 0, "retried": 0}
+        for index in self.order or range(len(results)):
+            batch = results[index]
+            batch.sent_ids = [sub['id'] for sub in batch.subscriptions]
+            self.sent += batch.sent_ids
+            if index == self.fail_at:
+                raise sqlite3.OperationalError("database is locked")
+            totals["sent"] += batch.sent
+            await on_batch_done(batch)
+        return totals
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    create_db(path, 30)
+    db = Database(path)
+    yield db
+    db.close()
+
+
+def test_enqueue_stores_shards_as_ranges(db):
+    async def scenario():
+        dispatcher = make_dispatcher(db, shard_size=12)
+        await dispatcher.segments.reload()
+        job_id, total, _ = await dispatcher.enqueue("news", "{}")
+        empty_id, empty_total, _ = await dispatcher.enqueue("urgent", "{}")
+        return job_id, total, await dispatcher.get_job(empty_id), empty_total
+
+    job_id, total, empty_job, empty_total = asyncio.run(scenario())
+    assert total == 30
+    shards = db.run_sync(lambda conn: conn.execute(
+        "SELECT first_id, last_id, total FROM dispatch_shards WHERE job_id = ? ORDER BY shard", (job_id,)
+    ).fetchall())
+    assert [tuple(row) for row in shards] == [(1, 12, 12), (13, 24, 12), (25, 30, 6)]
+    # Задача без получателей завершается сразу, без частей
+    assert (empty_total, empty_job["status"], empty_job["shards"]) == (0, "done", {})
+
+
+def test_claim_shard_respects_retry_at_and_lease(db):
+    first = make_dispatcher(db)
+    second = make_dispatcher(db)
+    second.worker_id = "other:1"
+    db.run_sync(lambda conn: (
+        conn.execute("INSERT INTO dispatch_jobs (id, target_type, payload, total) VALUES (1, 'news', '{}', 30)"),
+        conn.executemany(
+            "INSERT INTO dispatch_shards (job_id, shard, first_id, last_id, total, retry_at) VALUES (1, ?, ?, ?, 10, ?)",
+            [(0, 1, 10, None), (1, 11, 20, time.time() + 60), (2, 21, 30, time.time() - 1)]
+        ),
+        conn.commit()
+    ))
+
+    shard = db.run_sync(first._claim_shard)
+    assert (shard["shard"], shard["cursor"], shard["target_type"]) == (0, 0, "news")
+    # Часть в аренде и часть с отложенным повтором не выдаются
+    assert db.run_sync(second._claim_shard)["shard"] == 2
+    assert db.run_sync(second._claim_shard) is None
+
+    # Аренда истекла: часть забирает другой воркер, прежний её теряет
+    db.run_sync(lambda conn: (conn.execute("UPDATE dispatch_shards SET lease_until = 0 WHERE shard = 0"), conn.commit()))
+    assert db.run_sync(second._claim_shard)["shard"] == 0
+    assert db.run_sync(first._renew_lease, shard) is False
+    assert db.run_sync(first._retry_shard, shard, "ошибка") is True
+    db.run_sync(first._release_shard, shard)
+    row = db.run_sync(lambda conn: conn.execute(
+        "SELECT status, worker, attempts FROM dispatch_shards WHERE shard = 0").fetchone())
+    assert tuple(row) == ("running", "other:1", 0)
+
+
+def test_retry_shard_backoff_and_limit(db, monkeypatch):
+    monkeypatch.setattr(jobs, "DISPATCH_SHARD_MAX_ATTEMPTS", 3)
+    dispatcher = make_dispatcher(db)
+    db.run_sync(lambda conn: (
+        conn.execute("INSERT INTO dispatch_jobs (id, target_type, payload, total) VALUES (1, 'news', '{}', 30)"),
+        conn.execute("INSERT INTO dispatch_shards (job_id, shard, first_id, last_id, total) VALUES (1, 0, 1, 30, 30)"),
+        conn.commit()
+    ))
+    shard = db.run_sync(dispatcher._claim_shard)
+    assert db.run_sync(dispatcher._retry_shard, shard, "ошибка") is True
+    row = db.run_sync(lambda conn: conn.execute("SELECT status, attempts, retry_at, error FROM dispatch_shards").fetchone())
+    assert (row["status"], row["attempts"], row["error"]) == ("queued", 1, "ошибка")
+    assert row["retry_at"] == pytest.approx(time.time() + jobs.DISPATCH_RETRY_BASE_DELAY, abs=5)
+
+    db.run_sync(lambda conn: (conn.execute("UPDATE dispatch_shards SET retry_at = 0"), conn.commit()))
+    shard = db.run_sync(dispatcher._claim_shard)
+    assert shard["attempts"] == 1
+    assert db.run_sync(dispatcher._retry_shard, shard, "ошибка") is True
+    db.run_sync(lambda conn: (conn.execute("UPDATE dispatch_shards SET retry_at = 0"), conn.commit()))
+    shard = db.run_sync(dispatcher._claim_shard)
+    # Третья попытка последняя
+    assert db.run_sync(dispatcher._retry_shard, shard, "ошибка") is False
+
+
+def test_resume_skips_finished_batches(db, monkeypatch):
+    """Пачки, завершенные раньше упавшей, при продолжении не отправляются повторно"""
+    monkeypatch.setattr(jobs, "DISPATCH_RETRY_BASE_DELAY", 0)
+
+    async def scenario():
+        # Пачки 1-8, 9-16, 17-24, 25-30: вторая падает после того, как записаны третья и четвертая
+        failing = FakeSender(order=[0, 2, 3, 1], fail_at=1)
+        dispatcher = make_dispatcher(db, failing, batch_size=8)
+        await dispatcher.segments.reload()
+        job_id, _, _ = await dispatcher.enqueue("news", "{}")
+        await dispatcher._run_shard(await db.run(dispatcher._claim_shard))
+        interrupted = await db.run(lambda conn: dict(conn.execute(
+            "SELECT status, cursor, handled, ahead FROM dispatch_shards").fetchone()))
+
+        resumed = FakeSender()
+        dispatcher.push_sender = resumed
+        shard = await db.run(dispatcher._claim_shard)
+        await dispatcher._run_shard(shard)
+        return failing, resumed, shard, interrupted, await dispatcher.get_job(job_id)
+
+    failing, resumed, shard, interrupted, job = asyncio.run(scenario())
+    assert sorted(failing.sent) == list(range(1, 31))
+    assert interrupted == {"status": "queued", "cursor": 8, "handled": 22, "ahead": "[[17, 24], [25, 30]]"}
+    assert (shard["cursor"], shard["ahead"]) == (8, [(17, 24), (25, 30)])
+    assert resumed.sent == list(range(9, 17))
+    assert (job["status"], job["total"], job["sent"], job["shards"]) == ("done", 30, 30, {"done": 1})
+
+
+def test_finish_shard_adjusts_total_for_removed_subscriptions(db):
+    async def scenario():
+        dispatcher = make_dispatcher(db, FakeSender(), batch_size=8)
+        await dispatcher.segments.reload()
+        job_id, total, _ = await dispatcher.enqueue("news", "{}")
+        # Подписки удалены между постановкой задачи и отправкой
+        await db.execute("DELETE FROM subscriptions WHERE id IN (3, 4, 5)")
+        await dispatcher._run_shard(await db.run(dispatcher._claim_shard))
+        return total, dispatcher.push_sender.sent, await dispatcher.get_job(job_id)
+
+    total, sent, job = asyncio.run(scenario())
+    assert total == 30
+    assert 3 not in sent and len(sent) == 27
+    assert (job["status"], job["total"], job["sent"], job["progress"]) == ("done", 27, 27, 100.0)
+
+
+def test_missing_vapid_key_fails_job_without_touching_subscriptions(db):
+    async def scenario():
+        sender = FakeSender()
+        sender.vapid_cache = None
+        dispatcher = make_dispatcher(db, sender, shard_size=12)
+        await dispatcher.segments.reload()
+        job_id, _, _ = await dispatcher.enqueue("news", "{}")
+        while (shard := await db.run(dispatcher._claim_shard)) is not None:
+            await dispatcher._run_shard(shard)
+        return sender, await dispatcher.get_job(job_id)
+
+    sender, job = asyncio.run(scenario())
+    assert sender.sent == []
+    assert (job["status"], job["error"], job["shards"]) == ("failed", "VAPID_PRIVATE_KEY не задан", {"failed": 3})
+    assert db.run_sync(lambda conn: conn.execute("SELECT MAX(failure_count) FROM subscriptions").fetchone()[0]) == 0
+
+
+def test_worker_survives_claim_errors(db, monkeypatch):
+    monkeypatch.setattr(jobs, "DISPATCH_POLL_INTERVAL", 0.01)
+
+    async def scenario():
+        dispatcher = make_dispatcher(db, FakeSender())
+        await dispatcher.segments.reload()
+        claim = dispatcher._claim_shard
+        errors = [sqlite3.OperationalError("database is locked")] * 2
+
+        def flaky_claim(conn):
+            if errors:
+                raise errors.pop()
+            return claim(conn)
+
+        dispatcher._claim_shard = flaky_claim
+        job_id, _, _ = await dispatcher.enqueue("news", "{}")
+        worker = asyncio.ensure_future(dispatcher._worker())
+        try:
+            for _ in range(200):
+                job = await dispatcher.get_job(job_id)
+                if job["status"] == "done":
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+        return job
+
+    assert asyncio.run(scenario())["status"] == "done"
+
+
+@pytest.mark.parametrize("failures, lost", [(1, False), (100, True)])
+def test_keep_lease_retries_renewal_errors(db, failures, lost):
+    async def scenario():
+        dispatcher = make_dispatcher(db, lease=0.15)
+        errors = [sqlite3.OperationalError("database is locked")] * failures
+
+        def flaky_renew(conn, shard):
+            if errors:
+                raise errors.pop()
+            return True
+
+        dispatcher._renew_lease = flaky_renew
+        sending = asyncio.ensure_future(asyncio.sleep(0.5))
+        keeper = asyncio.ensure_future(dispatcher._keep_lease({"job_id": 1, "shard": 0}, sending))
+        await asyncio.gather(sending, return_exceptions=True)
+        result = keeper.result() if keeper.done() else None
+        keeper.cancel()
+        return sending.cancelled(), result
+
+    cancelled, result = asyncio.run(scenario())
+    # Одна ошибка не останавливает продление; без продления дольше аренды отправка прекращается
+    assert (cancelled, result) == ((True, True) if lost else (False, None))
+
+
+def test_stale_worker_cannot_record_or_finish(db):
+    """Воркер с истекшей арендой не меняет итоги и статус части нового владельца"""
+    async def scenario():
+        stale = make_dispatcher(db, FakeSender(), batch_size=8)
+        await stale.segments.reload()
+        job_id, _, _ = await stale.enqueue("news", "{}")
+        shard = await db.run(stale._claim_shard)
+        await db.execute("UPDATE dispatch_shards SET lease_until = 0")
+        owner = make_dispatcher(db)
+        owner.worker_id = "other:1"
+        assert (await db.run(owner._claim_shard))["shard"] == shard["shard"]
+
+        batch = BatchResult([{"id": 1}])
+        batch.sent_ids = [1]
+        with pytest.raises(LeaseLost):
+            await db.run(stale._record_batch, shard, batch, 1)
+        with pytest.raises(LeaseLost):
+            await db.run(stale._finish_shard, shard, "done")
+        # Отправка целиком: пачки не записываются, часть остается у нового владельца
+        await stale._run_shard(shard)
+        return await stale.get_job(job_id)
+
+    job = asyncio.run(scenario())
+    assert (job["status"], job["total"], job["sent"], job["shards"]) == ("running", 30, 0, {"running": 1})
+    row = db.run_sync(lambda conn: conn.execute("SELECT worker, handled, cursor FROM dispatch_shards").fetchone())
+    assert tuple(row) == ("other:1", 0, None)
+
+
+def test_enqueue_supersedes_queued_job_with_same_topic(db):
+    async def scenario():
+        dispatcher = make_dispatcher(db, shard_size=12)
+        await dispatcher.segments.reload()
+        old_id, _, _ = await dispatcher.enqueue("news", "{}", topic="sale")
+        other_topic, _, _ = await dispatcher.enqueue("news", "{}", topic="digest")
+        other_target, _, _ = await dispatcher.enqueue("news | promo", "{}", topic="sale")
+        new_id, _, superseded = await dispatcher.enqueue("news", "{}", topic="sale")
+        jobs_by_id = {job_id: await dispatcher.get_job(job_id) for job_id in (old_id, other_topic, other_target, new_id)}
+        return old_id, new_id, superseded, jobs_by_id
+
+    old_id, new_id, superseded, jobs_by_id = asyncio.run(scenario())
+    assert superseded == 1
+    old = jobs_by_id.pop(old_id)
+    assert (old["status"], old["error"], old["shards"]) == ("superseded", f"заменена рассылкой {new_id}", {"superseded": 3})
+    assert {job["status"] for job in jobs_by_id.values()} == {"queued"}
+
+
+def test_enqueue_supersedes_scheduled_job(db):
+    async def scenario():
+        dispatcher = make_dispatcher(db)
+        await dispatcher.segments.reload()
+        scheduled_id, _ = await dispatcher.schedule("news", "{}", time.time() + 3600, topic="sale")
+        scheduled = await dispatcher.get_job(scheduled_id)
+        _, _, superseded = await dispatcher.enqueue("news", "{}", topic="sale")
+        # Замененная отложенная задача при наступлении срока не отправляется
+        return scheduled, superseded, await dispatcher.activate(scheduled_id), await dispatcher.get_job(scheduled_id)
+
+    scheduled, superseded, activated, job = asyncio.run(scenario())
+    assert (scheduled["status"], scheduled["progress"]) == ("scheduled", None)
+    assert superseded == 1
+    assert activated is None
+    assert (job["status"], job["shards"]) == ("superseded", {})
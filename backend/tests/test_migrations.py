@@ -0,0 +1,84 @@
+import sqlite3
+
+import pytest
+
+from migrations import SCHEMA_VERSION, INITIAL_TYPES, get_version, migrate
+
+# Схема прежнего init_db; subscription_type он добавлял отдельным ALTER TABLE
+LEGACY_SCHEMA = """
+    CREATE TABLE subscription_types (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type_key TEXT UNIQUE NOT NULL,
+        type_name TEXT NOT NULL,
+        type_description TEXT,
+        type_color TEXT DEFAULT '#e2e3e5',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT INTO subscription_types (type_key, type_name) VALUES ('general', 'Общие'), ('news', 'Новости');
+    CREATE TABLE subscriptions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        endpoint TEXT UNIQUE,
+        auth_key TEXT,
+        p256dh_key TEXT,
+        user_agent TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    INSERT INTO subscriptions (endpoint, auth_key, p256dh_key) VALUES ('https://push.example/1', 'a', 'p');
+"""
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def schema(conn):
+    """Таблицы, индексы и триггеры с колонками таблиц"""
+    objects = {}
+    for kind, name in conn.execute("SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'"):
+        columns = [tuple(row)[1:] for row in conn.execute(f"PRAGMA table_info({name})")] if kind == "table" else None
+        objects[name] = (kind, columns)
+    return objects
+
+
+def test_migrate_new_database(tmp_path):
+    conn = connect(tmp_path / "new.db")
+    assert migrate(conn) == SCHEMA_VERSION
+    assert get_version(conn) == SCHEMA_VERSION
+    assert [row[0] for row in conn.execute("SELECT type_key FROM subscription_types ORDER BY id")] == \
+        [type_key for type_key, *_ in INITIAL_TYPES]
+    # Повторный запуск ничего не делает
+    assert migrate(conn) == 0
+
+
+@pytest.mark.parametrize("with_type_column", [False, True])
+def test_migrate_legacy_database(tmp_path, with_type_column):
+    conn = connect(tmp_path / "legacy.db")
+    conn.executescript(LEGACY_SCHEMA)
+    if with_type_column:
+        conn.executescript("""
+            ALTER TABLE subscriptions ADD COLUMN subscription_type TEXT DEFAULT 'general';
+            UPDATE subscriptions SET subscription_type = NULL;
+            INSERT INTO subscriptions (endpoint, auth_key, p256dh_key, subscription_type)
+            VALUES ('https://push.example/2', 'a', 'p', 'news');
+        """)
+    assert get_version(conn) == 0
+
+    assert migrate(conn) == SCHEMA_VERSION
+    fresh = connect(tmp_path / "fresh.db")
+    migrate(fresh)
+    assert schema(conn) == schema(fresh)
+    # Свои типы сохранены, подписки без типа получили general
+    assert [row[0] for row in conn.execute("SELECT type_key FROM subscription_types")] == ["general", "news"]
+    members = conn.execute("SELECT subscription_id, type_key FROM subscription_type_members ORDER BY 1")
+    assert [tuple(row) for row in members] == [(1, "general"), (2, "news")][:1 + with_type_column]
+
+    # Новые подписки раскладываются по типам триггерами
+    sub_id = conn.execute(
+        "INSERT INTO subscriptions (endpoint, auth_key, p256dh_key, type_keys) VALUES ('https://push.example/3', 'a', 'p', ?)",
+        ('["news", "general"]',)
+    ).lastrowid
+    conn.commit()
+    members = conn.execute("SELECT type_key FROM subscription_type_members WHERE subscription_id = ? ORDER BY 1", (sub_id,))
+    assert [row[0] for row in members] == ["general", "news"]
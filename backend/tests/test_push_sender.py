@@ -0,0 +1,205 @@
+import time
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import push_sender
+from push_sender import AdaptiveLimiter, PushSender, parse_retry_after, retry_delay
+
+
+# ---------- Retry-After и задержка повтора ----------
+
+@pytest.mark.parametrize("value, expected", [
+    (None, None), ("", None), ("120", 120.0), ("1.5", 1.5), ("-5", 0.0), ("soon", None),
+])
+def test_parse_retry_after(value, expected):
+    assert parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_http_date():
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 55 <= parse_retry_after(date) <= 60
+    past = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=60), usegmt=True)
+    assert parse_retry_after(past) == 0.0
+
+
+def test_retry_delay_backoff(monkeypatch):
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_BASE_DELAY", 1.0)
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_MAX_DELAY", 10.0)
+    monkeypatch.setattr(push_sender.random, "uniform", lambda low, high: high)
+    assert [retry_delay(attempt) for attempt in range(1, 6)] == [1.0, 2.0, 4.0, 8.0, 10.0]
+    # Jitter - не меньше половины задержки
+    monkeypatch.setattr(push_sender.random, "uniform", lambda low, high: low)
+    assert retry_delay(3) == 2.0
+
+
+def test_retry_delay_respects_retry_after(monkeypatch):
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_BASE_DELAY", 1.0)
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_MAX_DELAY", 10.0)
+    monkeypatch.setattr(push_sender.random, "uniform", lambda low, high: high)
+    assert retry_delay(1, retry_after=7) == 7
+    assert retry_delay(4, retry_after=3) == 8.0
+    assert retry_delay(1, retry_after=3600) == 10.0
+
+
+# ---------- AdaptiveLimiter ----------
+
+def test_limiter_acquire_waits_for_release():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=2, max_limit=10)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done() and limiter.stats()["waiting"] == 1
+        limiter.release()
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 2
+
+    asyncio.run(scenario())
+
+
+def test_limiter_cancelled_waiter_passes_slot():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=1, max_limit=10)
+        await limiter.acquire()
+        first = asyncio.ensure_future(limiter.acquire())
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # Первого будят и сразу отменяют: место должно достаться второму
+        limiter.release()
+        first.cancel()
+        await asyncio.wait_for(second, 1)
+        assert first.cancelled()
+        assert limiter.in_flight == 1
+
+        # Отмена до пробуждения не занимает место
+        third = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        third.cancel()
+        await asyncio.gather(third, return_exceptions=True)
+        limiter.release()
+        assert limiter.in_flight == 0
+        await asyncio.wait_for(limiter.acquire(), 1)
+
+    asyncio.run(scenario())
+
+
+def test_limiter_aimd(monkeypatch):
+    monkeypatch.setattr(push_sender, "PUSH_LIMIT_BACKOFF", 0.5)
+    limiter = AdaptiveLimiter(initial=8, min_limit=2, max_limit=9, latency_target=1.0)
+    limiter.record(0.1, congested=False)
+    assert limiter.limit == pytest.approx(8 + 1 / 8)
+    limiter.record(0.1, congested=True)
+    assert limiter.limit == pytest.approx((8 + 1 / 8) / 2)
+    # Повторный сигнал перегрузки в пределах latency_target не снижает лимит снова
+    limiter.record(5.0, congested=False)
+    assert limiter.limit == pytest.approx((8 + 1 / 8) / 2)
+    for _ in range(3):
+        limiter._last_decrease -= 1.0
+        limiter.record(5.0, congested=False)
+    assert limiter.limit == 2
+    for _ in range(200):
+        limiter.record(0.1, congested=False)
+    assert limiter.limit == 9
+
+
+def test_limiter_block():
+    limiter = AdaptiveLimiter()
+    assert limiter.blocked_for() == 0
+    limiter.block(30)
+    limiter.block(5)
+    assert 29 < limiter.blocked_for() <= 30
+
+
+# ---------- Повторы при рассылке ----------
+
+def test_broadcast_retries_with_retry_after(monkeypatch):
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_BASE_DELAY", 0.01)
+    monkeypatch.setattr(push_sender, "encrypt_batch", lambda keys, payload: [(b"body", None)] * len(keys))
+    responses = {
+        # 429 с Retry-After, затем успех
+        1: [("retry", 429, 0.2), ("sent", 201, None)],
+        # 503 на каждую попытку
+        2: [("retry", 503, None)] * 10,
+        3: [("expired", 410, None)],
+    }
+    calls = []
+
+    async def deliver(sub, body, headers):
+        calls.append((sub['id'], time.monotonic()))
+        return responses[sub['id']].pop(0)
+
+    async def batches():
+        yield [{"id": sub_id, "endpoint": f"https://push-{sub_id}.example/x", "p256dh_key": "p",
+                "auth_key": "a", "subscription_type": "general"} for sub_id in responses]
+
+    async def scenario():
+        sender = PushSender(None, {}, concurrency=4, encrypt_processes=0, max_retries=2)
+        monkeypatch.setattr(sender, "_deliver", deliver)
+        done = []
+
+        async def on_batch_done(batch):
+            done.append(batch)
+
+        try:
+            totals = await asyncio.wait_for(sender.broadcast(batches(), "{}", on_batch_done), 10)
+        finally:
+            await sender.close()
+        return sender, totals, done
+
+    sender, totals, done = asyncio.run(scenario())
+    # failed включает истекшие подписки
+    assert totals == {"sent": 1, "failed": 2, "expired": 1, "retried": 3}
+    [batch] = done
+    by_id = {entry[0]: entry for entry in batch.deliveries}
+    assert (by_id[1][1], by_id[1][2], by_id[1][4]) == ("sent", 201, 2)
+    assert (by_id[2][1], by_id[2][2], by_id[2][4]) == ("failed", 503, 3)
+    assert (by_id[3][1], by_id[3][2], by_id[3][4]) == ("expired", 410, 1)
+    # Повтор после 429 - не раньше Retry-After, и сервис заблокирован на это время
+    first, second = [at for sub_id, at in calls if sub_id == 1]
+    assert second - first >= 0.2
+    assert sender.limiters["push-1.example"].blocked_until > 0
+
+
+def test_broadcast_rejects_only_subscription_errors(monkeypatch):
+    """В failure_count попадают только отказы из-за самой подписки"""
+    monkeypatch.setattr(push_sender, "PUSH_RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(push_sender, "encrypt_batch", lambda keys, payload: [
+        (None, "invalid key") if p256dh_key == "bad" else (b"body", None) for p256dh_key, _ in keys
+    ])
+    responses = {
+        1: ("failed", 400, None),
+        2: ("failed", 403, None),
+        3: ("failed", 413, None),
+        4: ("retry", 503, None),
+        # Локальная ошибка (например, нет ключа VAPID)
+        5: ("failed", None, None),
+    }
+
+    async def deliver(sub, body, headers):
+        return responses[sub['id']]
+
+    async def batches():
+        yield [{"id": sub_id, "endpoint": "https://push.example/x", "p256dh_key": "bad" if sub_id == 6 else "p",
+                "auth_key": "a", "subscription_type": "general"} for sub_id in range(1, 7)]
+
+    async def scenario():
+        sender = PushSender(None, {}, concurrency=2, encrypt_processes=0, max_retries=1)
+        monkeypatch.setattr(sender, "_deliver", deliver)
+        done = []
+
+        async def on_batch_done(batch):
+            done.append(batch)
+
+        try:
+            await asyncio.wait_for(sender.broadcast(batches(), "{}", on_batch_done), 10)
+        finally:
+            await sender.close()
+        return done
+
+    [batch] = asyncio.run(scenario())
+    assert sorted(batch.failed_ids) == [1, 2, 3, 4, 5, 6]
+    assert sorted(batch.rejected_ids) == [1, 6]
@@ -0,0 +1,119 @@
+import random
+
+import pytest
+
+from segments import (SegmentIndex, parse_target, format_target, target_type_keys,
+                      bitmap_from_ids, iter_ids, split_ranges)
+
+
+def make_index(members):
+    """SegmentIndex без БД: members - {type_key: [id, ...]}"""
+    index = SegmentIndex(db=None, sync_interval=0)
+    index._replace({type_key: bitmap_from_ids(ids) for type_key, ids in members.items()})
+    return index
+
+
+# ---------- Выражения таргетинга ----------
+
+@pytest.mark.parametrize("text, expected", [
+    ("news", ("type", "news")),
+    ("ALL", ("all",)),
+    ("news | promo", ("or", ("type", "news"), ("type", "promo"))),
+    ("news OR promo and !urgent", ("or", ("type", "news"), ("and", ("type", "promo"), ("not", ("type", "urgent"))))),
+    ("(news | promo) & NOT urgent", ("and", ("or", ("type", "news"), ("type", "promo")), ("not", ("type", "urgent")))),
+    ("!!news", ("not", ("not", ("type", "news")))),
+])
+def test_parse_target(text, expected):
+    assert parse_target(text) == expected
+
+
+@pytest.mark.parametrize("text", ["", "news |", "(news", "news)", "& news", "news promo", "news $ promo", None])
+def test_parse_target_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        parse_target(text)
+
+
+@pytest.mark.parametrize("text, canonical", [
+    ("news", "news"),
+    ("news  or  promo", "news | promo"),
+    ("(news | promo) & !urgent", "(news | promo) & !urgent"),
+    ("!(news & promo)", "!(news & promo)"),
+    ("!(news | promo) | all", "!(news | promo) | all"),
+    ("news & (promo & urgent)", "news & promo & urgent"),
+    ("(news)", "news"),
+])
+def test_format_target_round_trip(text, canonical):
+    assert format_target(parse_target(text)) == canonical
+    # Каноническая запись - неподвижная точка
+    assert format_target(parse_target(canonical)) == canonical
+
+
+def test_format_target_preserves_audience():
+    index = make_index({"news": [1, 2, 3, 7], "promo": [3, 4, 7, 9], "urgent": [2, 7, 8]})
+    for text in ["news | promo & !urgent", "!(news | promo) | urgent", "news & (promo | !urgent)", "!!news & all"]:
+        tree = parse_target(text)
+        assert index.evaluate(parse_target(format_target(tree))) == index.evaluate(tree)
+
+
+def test_target_type_keys():
+    assert target_type_keys(parse_target("(news | promo) & !urgent | all")) == {"news", "promo", "urgent"}
+
+
+# ---------- Битовые карты ----------
+
+def test_iter_ids_ranges():
+    ids = [0, 1, 7, 8, 9, 63, 64, 1000, 1001]
+    bitmap = bitmap_from_ids(ids)
+    assert list(iter_ids(bitmap, after_id=-1)) == ids
+    assert list(iter_ids(bitmap)) == ids[1:]
+    assert list(iter_ids(bitmap, after_id=7)) == [8, 9, 63, 64, 1000, 1001]
+    assert list(iter_ids(bitmap, after_id=8, last_id=64)) == [9, 63, 64]
+    assert list(iter_ids(bitmap, after_id=9, last_id=62)) == []
+    assert list(iter_ids(bitmap, after_id=64, last_id=64)) == []
+    assert list(iter_ids(bitmap, after_id=1001)) == []
+    assert list(iter_ids(0)) == []
+
+
+def test_iter_ids_matches_brute_force():
+    rng = random.Random(1)
+    ids = sorted(rng.sample(range(1, 5000), 700))
+    bitmap = bitmap_from_ids(ids)
+    for _ in range(50):
+        after_id = rng.randrange(-1, 5000)
+        last_id = rng.choice([None, rng.randrange(0, 5000)])
+        expected = [i for i in ids if i > after_id and (last_id is None or i <= last_id)]
+        assert list(iter_ids(bitmap, after_id, last_id)) == expected
+
+
+@pytest.mark.parametrize("count, size", [(0, 10), (1, 10), (10, 10), (11, 10), (2500, 100), (2500, 999)])
+def test_split_ranges(count, size):
+    rng = random.Random(count)
+    ids = sorted(rng.sample(range(1, 200000), count))
+    ranges = split_ranges(bitmap_from_ids(ids), size, block_bytes=64)
+    assert sum(total for _, _, total in ranges) == count
+    position = 0
+    for first_id, last_id, total in ranges:
+        assert total == (size if position + size <= count else count - position)
+        assert (first_id, last_id) == (ids[position], ids[position + total - 1])
+        position += total
+
+
+def test_apply_replaces_changed_subscriptions():
+    index = make_index({"news": [1, 2, 3], "promo": [2, 3]})
+    version = index.version
+    # 2 сменил типы, 3 удален (строк нет), 4 - новая подписка
+    index._apply([2, 3, 4], [(2, "urgent"), (4, "news"), (4, "promo")])
+    assert list(iter_ids(index.bitmaps["news"])) == [1, 4]
+    assert list(iter_ids(index.bitmaps["promo"])) == [4]
+    assert list(iter_ids(index.bitmaps["urgent"])) == [2]
+    assert list(iter_ids(index.all)) == [1, 2, 4]
+    assert index.version > version
+
+
+def test_apply_drops_empty_types_and_resets_stats():
+    index = make_index({"news": [1], "promo": [1, 2]})
+    assert index.stats()["types"] == {"news": 1, "promo": 2}
+    index._apply([1], [])
+    assert "news" not in index.bitmaps
+    assert index.stats() == {"total": 1, "types": {"promo": 1}, "overlaps": []}
+    assert index.count("news | promo") == 1
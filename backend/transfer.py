@@ -0,0 +1,149 @@
+"""Выгрузка и загрузка подписок и типов в формате NDJSON.
+
+Одна строка - один JSON-объект с полем kind:
+
+    {"kind": "header", "format": 1, "seq": 1234, "since_seq": null}
+    {"kind": "type", "type_key": "news", "type_name": "Новости", ...}
+    {"kind": "subscription", "id": 1, "endpoint": "...", "keys": {...}, "types": [...], ...}
+    {"kind": "end", "subscriptions": 1}
+
+Подписки читаются страницами по id (WHERE id > последний ORDER BY id), а
+загрузка пишет их пачками по IMPORT_BATCH, поэтому память на обеих сторонах
+не зависит от числа подписок. Строка subscription совпадает с телом
+/api/subscribe, так что загрузка проверяет ее тем же parse_subscription.
+
+Перенос без остановки: полная выгрузка, затем выгрузки с since_seq = seq из
+заголовка предыдущей - в них попадают только подписки, изменённые после
+нее (по журналу subscription_changes). Удаленные подписки в догоняющую
+выгрузку не попадают: на новом узле их удалит первая рассылка (404/410).
+"""
+import os
+import json
+
+from changes import max_seq
+from segments import valid_type_key
+from type_registry import TYPE_FIELDS
+
+EXPORT_FORMAT = 1
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "2000"))
+IMPORT_BATCH = int(os.getenv("IMPORT_BATCH", "2000"))
+IMPORT_MAX_LINE = int(os.getenv("IMPORT_MAX_LINE", "65536"))
+IMPORT_MAX_ERRORS = 100
+
+EXPORT_FIELDS = """
+    id, endpoint, auth_key, p256dh_key,
+    COALESCE(type_keys, json_array(subscription_type)) AS type_keys,
+    user_agent, created_at
+"""
+
+TYPE_UPSERT = """
+    INSERT INTO subscription_types (type_key, type_name, type_description, type_color)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (type_key) DO UPDATE SET
+        type_name = excluded.type_name,
+        type_description = excluded.type_description,
+        type_color = excluded.type_color
+"""
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+# ---------- Выгрузка (выполняется в потоке пула БД) ----------
+
+def read_export_start(conn, since_seq=None):
+    """(seq журнала на момент начала, типы). ValueError, если с since_seq
+    уже нельзя выгрузить только изменения"""
+    seq = max_seq(conn)
+    if since_seq is not None:
+        first = conn.execute("SELECT MIN(seq) FROM subscription_changes").fetchone()[0]
+        if since_seq > seq:
+            raise ValueError(f"since_seq {since_seq} больше последнего seq {seq}: БД пересоздана")
+        if since_seq < seq and (first is None or first > since_seq + 1):
+            raise ValueError("журнал изменений уже очищен после since_seq, нужна полная выгрузка")
+    types = conn.execute(f"SELECT {TYPE_FIELDS} FROM subscription_types ORDER BY id").fetchall()
+    return seq, [dict(row) for row in types]
+
+
+def read_export_page(conn, after_id, limit, since_seq=None, until_seq=None):
+    """Следующая страница подписок после after_id (только изменённые в
+    (since_seq, until_seq], если since_seq задан)"""
+    if since_seq is None:
+        return conn.execute(
+            f"SELECT {EXPORT_FIELDS} FROM subscriptions WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
+    return conn.execute(f"""
+        SELECT {EXPORT_FIELDS} FROM subscriptions
+        WHERE id > ? AND id IN (
+            SELECT subscription_id FROM subscription_changes WHERE seq > ? AND seq <= ?
+        )
+        ORDER BY id LIMIT ?
+    """, (after_id, since_seq, until_seq, limit)).fetchall()
+
+
+def subscription_record(row):
+    return {
+        "kind": "subscription",
+        "id": row["id"],
+        "endpoint": row["endpoint"],
+        "keys": {"auth": row["auth_key"], "p256dh": row["p256dh_key"]},
+        "types": json.loads(row["type_keys"]),
+        "user_agent": row["user_agent"],
+        "created_at": row["created_at"]
+    }
+
+
+async def export_lines(db, seq, types, since_seq=None, page_size=EXPORT_PAGE_SIZE):
+    """Строки выгрузки; seq и types - результат read_export_start.
+    Каждая страница подписок отдается одним фрагментом"""
+    yield _line({"kind": "header", "format": EXPORT_FORMAT, "seq": seq, "since_seq": since_seq})
+    yield "".join(_line({"kind": "type", **t}) for t in types)
+    after_id = 0
+    exported = 0
+    while True:
+        rows = await db.run(read_export_page, after_id, page_size, since_seq, seq)
+        if not rows:
+            break
+        after_id = rows[-1]["id"]
+        exported += len(rows)
+        yield "".join(_line(subscription_record(row)) for row in rows)
+    yield _line({"kind": "end", "subscriptions": exported})
+
+
+# ---------- Загрузка ----------
+
+async def read_lines(chunks, max_line=IMPORT_MAX_LINE):
+    """(номер строки, строка) из потока байтов; пустые строки пропускаются.
+    ValueError, если строка длиннее max_line"""
+    buffer = b""
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if len(line) > max_line:
+                raise ValueError(f"строка {line_no} длиннее {max_line} байт")
+            if line.strip():
+                yield line_no, line
+        if len(buffer) > max_line:
+            raise ValueError(f"строка {line_no + 1} длиннее {max_line} байт")
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+def parse_type(record):
+    """Проверить строку type и подготовить параметры для TYPE_UPSERT"""
+    type_key = record.get("type_key")
+    type_name = record.get("type_name")
+    if not isinstance(type_key, str) or not valid_type_key(type_key):
+        raise ValueError(f"недопустимый type_key: {type_key!r}")
+    if not isinstance(type_name, str) or not type_name.strip():
+        raise ValueError("type_name обязателен")
+    type_description = record.get("type_description") or ""
+    type_color = record.get("type_color") or "#e2e3e5"
+    if not isinstance(type_description, str) or not isinstance(type_color, str):
+        raise ValueError("type_description и type_color должны быть строками")
+    return (type_key, type_name, type_description, type_color)
@@ -0,0 +1,108 @@
+"""Перенос подписок между узлами через /api/subscriptions/export и /import.
+
+Данные идут потоком фрагментами по CHUNK_SIZE, без чтения всей выгрузки в
+память:
+
+    python transfer_cli.py export --url http://old:5000 -o subscriptions.ndjson
+    python transfer_cli.py import --url http://new:5000 subscriptions.ndjson
+    python transfer_cli.py copy --source http://old:5000 --target http://new:5000
+
+Перенос без остановки: copy целиком, затем copy --since-seq N с seq,
+который напечатала предыдущая команда, пока изменений не станет ноль;
+после этого трафик переключается на новый узел и делается последний copy.
+"""
+import sys
+import json
+import asyncio
+import argparse
+
+import aiohttp
+
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=300)
+
+
+async def read_file(path):
+    """Фрагменты файла (или stdin для -) без блокировки event loop"""
+    stream = sys.stdin.buffer if path == "-" else open(path, "rb")
+    try:
+        while chunk := await asyncio.to_thread(stream.read, CHUNK_SIZE):
+            yield chunk
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+
+
+def export_params(since_seq):
+    return {} if since_seq is None else {"since_seq": since_seq}
+
+
+async def export(args):
+    output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    try:
+        async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+            async with session.get(f"{args.url}/api/subscriptions/export",
+                                   params=export_params(args.since_seq)) as response:
+                if response.status != 200:
+                    sys.exit(f"export: HTTP {response.status}: {await response.text()}")
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    output.write(chunk)
+        print(f"seq для следующей выгрузки: {response.headers['X-Export-Seq']}", file=sys.stderr)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+
+
+async def post_import(session, url, data):
+    async with session.post(f"{url}/api/subscriptions/import", data=data,
+                            headers={"Content-Type": "application/x-ndjson"}) as response:
+        if response.status != 200:
+            sys.exit(f"import: HTTP {response.status}: {await response.text()}")
+        result = await response.json()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if not result["complete"]:
+        sys.exit("import: выгрузка оборвалась (нет строки end)")
+    return result
+
+
+async def import_file(args):
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+        await post_import(session, args.url, read_file(args.file))
+
+
+async def copy(args):
+    async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+        async with session.get(f"{args.source}/api/subscriptions/export",
+                               params=export_params(args.since_seq)) as response:
+            if response.status != 200:
+                sys.exit(f"export: HTTP {response.status}: {await response.text()}")
+            # Тело выгрузки сразу уходит в загрузку на другом узле
+            result = await post_import(session, args.target, response.content.iter_chunked(CHUNK_SIZE))
+    print(f"seq для следующего copy: {result['source_seq']}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос подписок и типов в NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="выгрузить в файл")
+    export_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    export_parser.add_argument("--since-seq", type=int)
+    export_parser.add_argument("-o", "--output", default="-")
+
+    import_parser = commands.add_parser("import", help="загрузить из файла")
+    import_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    import_parser.add_argument("file", nargs="?", default="-")
+
+    copy_parser = commands.add_parser("copy", help="перенести с узла на узел")
+    copy_parser.add_argument("--source", required=True)
+    copy_parser.add_argument("--target", required=True)
+    copy_parser.add_argument("--since-seq", type=int)
+
+    args = parser.parse_args()
+    handler = {"export": export, "import": import_file, "copy": copy}[args.command]
+    asyncio.run(handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+TYPE_FIELDS = "type_key, type_name, type_description, type_color"
+
+# Как часто перечитывать типы, изменённые другими процессами (0 - не перечитывать)
+TYPE_REFRESH_INTERVAL = float(os.getenv("TYPE_REFRESH_INTERVAL", "5"))
+
+
+class TypeRegistry:
+    """Кэш типов подписок в памяти процесса.
+
+    Типы загружаются из subscription_types при старте и отдаются эндпоинтам
+    без обращения к БД. После любого изменения типов эндпоинты вызывают
+    reload(), который перечитывает таблицу и меняет version/etag.
+    Изменения, сделанные другими воркерами, подхватываются фоновым
+    перечитыванием раз в refresh_interval секунд.
+    """
+
+    def __init__(self, db, refresh_interval=TYPE_REFRESH_INTERVAL):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.types = []
+        self.by_key = {}
+        self.version = 0
+        self.etag = None
+        self._task = None
+
+    def _load(self, conn):
+        rows = conn.execute(f"SELECT {TYPE_FIELDS} FROM subscription_types ORDER BY id").fetchall()
+        return [dict(row) for row in rows]
+
+    def _apply(self, types):
+        # ETag зависит только от содержимого, поэтому совпадает у всех процессов
+        digest = hashlib.sha1(json.dumps(types, ensure_ascii=False).encode("utf8")).hexdigest()
+        etag = f'"types-{digest[:16]}"'
+        if etag == self.etag:
+            return
+        self.types = types
+        self.by_key = {t["type_key"]: t for t in types}
+        self.version += 1
+        self.etag = etag
+
+    async def reload(self):
+        """Перечитать типы из БД"""
+        self._apply(await self.db.run(self._load))
+
+    async def start(self):
+        """Загрузить типы и запустить фоновое перечитывание"""
+        await self.reload()
+        if self.refresh_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.reload()
+            except Exception:
+                logger.exception("Ошибка перечитывания типов подписок")
+
+    def exists(self, type_key):
+        return type_key in self.by_key
+
+    def get_name(self, type_key):
+        """Название типа или сам ключ, если тип неизвестен"""
+        type_info = self.by_key.get(type_key)
+        return type_info["type_name"] if type_info else type_key
@@ -415,7 +415,8 @@ async function sendNotification() {
         
         if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
         
-        const result = await response.json();
+        const { job_id } = await response.json();
+        const result = await waitForJob(job_id);
         
         alert(`✅ Сообщение отправлено\n\n` +
               `📊 Успешно доставлено: ${result.sent}\n` +
@@ -430,6 +431,22 @@ async function sendNotification() {
     }
 }
 
+// Ожидание завершения фоновой рассылки
+async function waitForJob(jobId) {
+    while (true) {
+        const response = await fetch(`${SERVER_URL}/api/jobs/${jobId}`);
+        if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+        
+        const job = await response.json();
+        console.log(`📨 Рассылка #${jobId}: ${job.progress ?? 0}%`);
+        if (job.status === 'done') return job;
+        if (job.status === 'failed') throw new Error(job.error || 'рассылка завершилась ошибкой');
+        if (job.status === 'superseded') throw new Error(job.error || 'рассылка заменена более новой');
+        
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
+}
+
 async function unsubscribeFromPush() {
     try {
         if (!pushSubscription) return;
@@ -19,6 +19,9 @@ self.addEventListener('push', function(event) {
         badge: data.badge || '/icons/badge.png',
         vibrate: [200, 100, 200],
         data: data.data || { url: '/' },
+        // Уведомление с той же темой заменяет предыдущее
+        tag: data.tag,
+        renotify: Boolean(data.tag),
         actions: [
             { action: 'open', title: 'Открыть' },
             { action: 'close', title: 'Закрыть' }